@@ -0,0 +1,71 @@
+import threading
+from variables import Variables
+
+VIEWER = "viewer"
+MEMBER = "member"
+ADMIN = "admin"
+# Each role can do everything the roles before it can
+ROLES = (VIEWER, MEMBER, ADMIN)
+
+
+def allows(role, required):
+    return role is not None and ROLES.index(role) >= ROLES.index(required)
+
+
+class AccessConfigError(ValueError):
+    """
+    variables.cfg lists users wrongly, e.g. with an unknown role.
+    """
+    pass
+
+
+class AccessList(object):
+    """
+    Telegram users allowed to use the bot, and their roles, from variables.cfg:
+
+        telegram_authorized_user=barakwei           admins, comma separated
+        telegram_users=alice:member,123456:viewer   other users by username or numeric id, with their role
+
+    Users are read from the config on every check, so changes apply without a restart. They're parsed and validated
+    once per change, a bad entry raises AccessConfigError.
+    """
+    def __init__(self):
+        self._parsed = (None, {})
+        self._lock = threading.Lock()
+
+    def role(self, user):
+        """
+        Returns the role of a message's 'from' user, None when they aren't allowed.
+        """
+        users = self.users()
+        for key in (str(user.get("id", "")), user.get("username")):
+            if key and key in users:
+                return users[key]
+        return None
+
+    def users(self):
+        variables = Variables()
+        source = (variables.get("telegram_users", ""), variables.get("telegram_authorized_user", ""))
+        with self._lock:
+            if self._parsed[0] != source:
+                self._parsed = (source, self._parse(*source))
+            return self._parsed[1]
+
+    def _parse(self, members, admins):
+        users = {}
+        for entry in members.split(","):
+            name, _, role = entry.strip().partition(":")
+            if not name:
+                continue
+            role = role.strip().lower() or VIEWER
+            if role not in ROLES:
+                raise AccessConfigError("Bad role for {name} in telegram_users: {role}, roles are {roles}".format(
+                                        name=name, role=role, roles=", ".join(ROLES)))
+            users[name.strip().lstrip("@")] = role
+        for name in admins.split(","):
+            if name.strip():
+                users[name.strip().lstrip("@")] = ADMIN
+        return users
+
+
+access_list = AccessList()
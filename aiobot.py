@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+import asyncio
+import telepot
+import telepot.aio
+import telepot.aio.helper
+import telepot.exception
+import telepot.helper
+from telepot.aio.loop import MessageLoop
+from bot import HomeBotConversation, start_sessions, start_snapshot_poller, start_stats_exporters
+from log_pipeline import configure_log
+from messaging import ThrottledSender, chat_bucket
+from variables import Variables
+
+
+class LoopSender(object):
+    """
+    Exposes an asyncio telepot Sender to code running on a worker thread.
+    """
+    def __init__(self, sender, loop):
+        self.sender = sender
+        self.loop = loop
+
+    def __getattr__(self, name):
+        method = getattr(self.sender, name)
+
+        def call(*args, **kwargs):
+            return asyncio.run_coroutine_threadsafe(method(*args, **kwargs), self.loop).result()
+        return call
+
+
+class AsyncHomeBot(HomeBotConversation):
+    """
+    The regular conversation logic, run on the worker pool (backends are blocking) and replying through the loop.
+    """
+    def __init__(self, bot, chat_id, loop):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.loop = loop
+        self.command_handler = self
+        self.sender = self._throttled(telepot.helper.Sender(bot, chat_id))
+
+    def _throttled(self, sender):
+        return ThrottledSender(LoopSender(sender, self.loop), chat_bucket(self.chat_id))
+
+    def editor(self, sent_message):
+        return self._throttled(telepot.aio.helper.Editor(self.bot, sent_message))
+
+    def close(self):
+        raise telepot.exception.StopListening()
+
+
+def main():
+    configure_log("bot")
+
+    bot_token = Variables()["telegram_token"]
+    start_snapshot_poller()
+    start_stats_exporters()
+
+    loop = asyncio.get_event_loop()
+    bot = telepot.aio.Bot(bot_token)
+    sessions = start_sessions(lambda chat_id: AsyncHomeBot(bot, chat_id, loop))
+
+    async def handle(msg):
+        # Only queues the message, the loop never waits on a backend
+        if telepot.flavor(msg) == 'chat':
+            sessions.dispatch(msg)
+
+    loop.create_task(MessageLoop(bot, handle).run_forever())
+    print('Listening ...')
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
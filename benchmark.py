@@ -0,0 +1,540 @@
+#!/usr/bin/python3
+"""
+Benchmarks the bot against in-process fakes of every backend, nothing reaches the real services.
+
+    benchmark.py [--torrents N] [--tasks N] [--iterations N] [--concurrency N] [--scenario NAME]... [--json]
+
+Fakes: a recording Telegram sender, a Transmission RPC server seeded with N torrents, a flexget executable
+printing N tasks, and HTTP stubs of the Flexget daemon, Crashplan and ThingSpeak APIs. Scripted conversations are fed
+to HomeBotConversation.on_chat_message, the chat logic HomeBot runs, and each scenario reports throughput,
+latency percentiles, failed runs, backend and Telegram calls per run and the process' peak RSS so far.
+A run fails when it raises, logs an error or gets an error reply. Run a single --scenario to see its own peak RSS.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+USERNAME = "benchmark"
+TRANSMISSION_STATUSES = (0, 4, 6)  # stopped, downloading, seeding
+# Replies the bot sends when a command didn't work. Prompts like "Please provide a task name" are a normal step.
+FAILED_REPLY = re.compile(r"fail|unavailable|error|not authorized|not allowed|unknown command|timed out|"
+                          r"exited with code|no flexget api", re.IGNORECASE)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeHTTPServer(object):
+    """
+    Local HTTP server counting requests per route. Subclasses implement handle(method, path, headers, body),
+    returning the status, headers and a JSON payload, or None for no body (e.g. a 304).
+    """
+    def __init__(self):
+        self.requests = {}
+        self._lock = threading.Lock()
+        fake = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Replies are written in several parts, Nagle would hold the last one back for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._reply('GET')
+
+            def do_POST(self):
+                self._reply('POST')
+
+            def _reply(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, headers, payload = fake.handle(method, self.path, self.headers, body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if payload is None:
+                    self.end_headers()
+                    return
+                data = json.dumps(payload).encode('utf-8')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        self.port = self.server.server_address[1]
+        self.url = "http://127.0.0.1:{port}".format(port=self.port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def count(self, route):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def request_count(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def handle(self, method, path, headers, body):
+        raise NotImplementedError
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeTransmission(FakeHTTPServer):
+    """
+    Transmission RPC: session id handshake, session-get/stats, torrent-get/add/start/stop/remove and free-space.
+    """
+    SESSION_ID = "benchmark-session"
+
+    def __init__(self, torrents):
+        self.torrents = {}
+        self.next_id = 1
+        self.torrents_lock = threading.Lock()
+        for index in range(torrents):
+            self._add("Benchmark_torrent.{index}.[1080p]*".format(index=index), TRANSMISSION_STATUSES[index % 3])
+        super(FakeTransmission, self).__init__()
+
+    def _add(self, name, status=4):
+        size = 1024 * 1024 * (self.next_id % 5000 + 1)
+        torrent = {'id': self.next_id, 'name': name, 'status': status, 'totalSize': size, 'sizeWhenDone': size,
+                   'leftUntilDone': 0 if status == 6 else size // 2, 'rateDownload': 1024 * (self.next_id % 97),
+                   'eta': -1 if status != 4 else 60 * (self.next_id % 600), 'uploadRatio': (self.next_id % 30) / 10.0,
+                   'hashString': '{id:040x}'.format(id=self.next_id)}
+        self.torrents[self.next_id] = torrent
+        self.next_id += 1
+        return torrent
+
+    def handle(self, method, path, headers, body):
+        if headers.get('X-Transmission-Session-Id') != self.SESSION_ID:
+            self.count('handshake')
+            return 409, {'X-Transmission-Session-Id': self.SESSION_ID}, {}
+        request = json.loads(body.decode('utf-8'))
+        self.count(request['method'])
+        arguments = self.rpc(request['method'], request.get('arguments', {}))
+        reply = {'result': 'success', 'arguments': arguments}
+        if 'tag' in request:
+            reply['tag'] = request['tag']
+        return 200, {}, reply
+
+    def rpc(self, method, arguments):
+        with self.torrents_lock:
+            if method == 'session-get':
+                return {'rpc-version': 15, 'rpc-version-minimum': 1, 'version': '2.94 (benchmark)',
+                        'download-dir': '/downloads'}
+            if method == 'session-stats':
+                return {'downloadSpeed': 0, 'uploadSpeed': 0, 'torrentCount': len(self.torrents)}
+            if method == 'free-space':
+                return {'path': arguments.get('path'), 'size-bytes': 512 * 1024 ** 3}
+            if method == 'torrent-get':
+                fields = arguments.get('fields') or []
+                # Every torrent counts as recently active, like a busy daemon
+                return {'torrents': [{field: torrent[field] for field in fields if field in torrent}
+                                     for torrent in self._selected(arguments)], 'removed': []}
+            if method == 'torrent-add':
+                torrent = self._add(arguments.get('filename', 'magnet'))
+                return {'torrent-added': {key: torrent[key] for key in ('id', 'name', 'hashString')}}
+            if method in ('torrent-start', 'torrent-start-now', 'torrent-stop'):
+                for torrent in self._selected(arguments):
+                    torrent['status'] = 0 if method == 'torrent-stop' else 4
+                return {}
+            if method == 'torrent-remove':
+                for torrent in self._selected(arguments):
+                    del self.torrents[torrent['id']]
+                return {}
+            return {}
+
+    def _selected(self, arguments):
+        ids = arguments.get('ids')
+        if ids is None or ids == 'recently-active':
+            return list(self.torrents.values())
+        ids = ids if isinstance(ids, list) else [ids]
+        return [self.torrents[torrent_id] for torrent_id in ids if torrent_id in self.torrents]
+
+
+class FakeCrashplan(FakeHTTPServer):
+    def __init__(self, computers=3):
+        self.computers = computers
+        super(FakeCrashplan, self).__init__()
+
+    def handle(self, method, path, headers, body):
+        route = path.split('?')[0]
+        self.count(route)
+        now = datetime.utcnow()
+        if route == '/api/Account/my':
+            return 200, {}, {'data': {'accountId': 42}}
+        if route == '/api/Subscription':
+            return 200, {}, {'data': [{'name': 'Benchmark plan',
+                                       'expirationDate': (now + timedelta(days=90)).isoformat()}]}
+        if route == '/api/computer':
+            usage = {'selectedBytes': 500 * 1024 ** 3, 'todoBytes': 1024 ** 3, 'selectedFiles': 123456,
+                     'lastCompletedBackup': (now - timedelta(hours=3)).isoformat()}
+            return 200, {}, {'data': {'computers': [{'name': 'computer_{index}'.format(index=index),
+                                                     'lastConnected': now.isoformat(), 'backupUsage': [usage]}
+                                                    for index in range(self.computers)]}}
+        return 404, {}, {}
+
+
+class FakeFlexgetAPI(FakeHTTPServer):
+    """
+    Flexget daemon web API: status/, status/ID/executions/ and tasks/execute/. Every third task failed its last run.
+    """
+    def __init__(self, tasks):
+        now = datetime.now()
+        self.tasks = [{'id': index, 'name': 'benchmark_task_{index}'.format(index=index),
+                       'last_execution': {'start': (now - timedelta(minutes=index)).isoformat(),
+                                          'succeeded': index % 3 != 0}}
+                      for index in range(tasks)]
+        self.last_success = (now - timedelta(days=1)).isoformat()
+        super(FakeFlexgetAPI, self).__init__()
+
+    def handle(self, method, path, headers, body):
+        route = urlsplit(path).path
+        if method == 'GET' and route == '/api/status/':
+            self.count('status')
+            return 200, {}, self.tasks
+        if method == 'GET' and route.startswith('/api/status/') and route.endswith('/executions/'):
+            self.count('executions')
+            return 200, {}, [{'start': self.last_success, 'succeeded': True}]
+        if method == 'POST' and route == '/api/tasks/execute/':
+            self.count('execute')
+            names = set(json.loads(body.decode('utf-8'))['tasks'])
+            return 200, {}, {'tasks': [{'name': task['name']} for task in self.tasks if task['name'] in names]}
+        return 404, {}, {'message': 'Not found'}
+
+
+class FakeThingSpeak(FakeHTTPServer):
+    def handle(self, method, path, headers, body):
+        self.count('bulk_update')
+        return 202, {}, {'success': True}
+
+
+def write_fake_flexget(directory, tasks):
+    """
+    Writes a flexget executable answering 'status --porcelain' with tasks rows and 'execute' with a line.
+    """
+    path = os.path.join(directory, 'flexget')
+    with open(path, 'w') as f:
+        f.write("""#!{python}
+import sys
+if sys.argv[1:2] == ['status']:
+    print("Task | Last execution | Last success")
+    for index in range({tasks}):
+        print("benchmark_task_{{index}} | 2024-01-01 10:{{minute:02d}} | 2024-01-01 09:00".format(
+            index=index, minute=index % 60))
+else:
+    print("Executed " + " ".join(sys.argv[1:]))
+""".format(python=sys.executable, tasks=tasks))
+    os.chmod(path, 0o755)
+    return path
+
+
+class FakeSender(object):
+    """
+    Records what the bot sends instead of calling Telegram, keeping the replies that report a failure.
+    Also stands in for the message editor, whose editMessageText only takes the text.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def _record(self, text=None):
+        with self._lock:
+            self.calls += 1
+            if text is not None and FAILED_REPLY.search(text):
+                self.failures.append(text)
+            return {'message_id': self.calls}
+
+    def sendMessage(self, text, **kwargs):
+        return self._record(text)
+
+    def sendDocument(self, document, **kwargs):
+        return self._record()
+
+    def editMessageText(self, *args, **kwargs):
+        return self._record(kwargs.get('text', args[-1]))
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Counts the errors logged by each thread, a conversation runs on a single one.
+    """
+    def __init__(self):
+        super(ErrorCounter, self).__init__(logging.ERROR)
+        self._local = threading.local()
+
+    def emit(self, record):
+        self._local.errors = self.errors() + 1
+
+    def errors(self):
+        return getattr(self._local, 'errors', 0)
+
+    def reset(self):
+        self._local.errors = 0
+
+
+class InlineExecutor(object):
+    """
+    Runs submitted calls right away, so streamed command replies count in the run that started them.
+    """
+    def submit(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+
+def conversation_class():
+    import telepot.exception
+    from bot import HomeBotConversation
+    from messaging import ThrottledSender, TokenBucket
+
+    class BenchmarkConversation(HomeBotConversation):
+        """
+        The chat logic of HomeBot over a fake sender, through the same ThrottledSender wrapper with no rate limit.
+        """
+        def __init__(self, chat_id, sender):
+            self.chat_id = chat_id
+            self.sender = ThrottledSender(sender, TokenBucket(1e9, 1e9))
+            self._raw_sender = sender
+            self.command_handler = self
+
+        def editor(self, sent_message):
+            return self.sender
+
+        def close(self):
+            raise telepot.exception.StopListening()
+
+    return BenchmarkConversation, telepot.exception.StopListening
+
+
+def chat_scenario(*texts, **config):
+    """
+    config overrides variables.cfg during the scenario, values naming a fake (e.g. 'flexget_api') become its URL.
+    """
+    return ('chat', texts, config)
+
+
+SCENARIOS = [
+    ("torrents list", chat_scenario("/torrents /list")),
+    ("torrents start", chat_scenario("/torrents /start status:stopped")),
+    ("torrents stop", chat_scenario("/torrents", "/stop", "1-20")),
+    ("torrents add", chat_scenario("/torrents /add magnet:?xt=urn:btih:0123456789abcdef0123456789abcdef01234567")),
+    ("flexget list", chat_scenario("/flexget /list")),
+    ("flexget execute", chat_scenario("/flexget", "/execute", "benchmark_task_1")),
+    ("flexget api list", chat_scenario("/flexget /list", flexget_api_url='flexget_api')),
+    ("flexget api execute", chat_scenario("/flexget", "/execute", "benchmark_task_1", flexget_api_url='flexget_api')),
+    ("crashplan", chat_scenario("/crashplan")),
+    ("system disk", chat_scenario("/system /disk")),
+    ("system stats", chat_scenario("/system /stats")),
+    ("thingspeak upload", ('thingspeak', (), {})),
+]
+
+
+class Benchmark(object):
+    def __init__(self, torrents, tasks, directory):
+        self.directory = directory
+        self.transmission = FakeTransmission(torrents)
+        self.flexget_api = FakeFlexgetAPI(tasks)
+        self.crashplan = FakeCrashplan()
+        self.thingspeak = FakeThingSpeak()
+        self.servers = (self.transmission, self.flexget_api, self.crashplan, self.thingspeak)
+        self.fakes = {'flexget_api': self.flexget_api}
+        self.config = {
+            "telegram_authorized_user": USERNAME,
+            "flexget_path": write_fake_flexget(directory, tasks),
+            "crashplan_user": "benchmark",
+            "crashplan_password": "benchmark",
+            "mountpoint_regex": "/",
+            "snapshot_poller": "NO",
+        }
+        self._install_fakes()
+        self.conversation_class, self.stop_listening = conversation_class()
+        self._next_chat_id = 0
+        self._chat_lock = threading.Lock()
+        self.error_counter = ErrorCounter()
+        logging.getLogger().addHandler(self.error_counter)
+
+    def _install_fakes(self):
+        import bot
+        import crashplan
+        import shell
+        import transmission_client
+        from metrics import MetricsStore
+        from variables import Variables
+
+        config = self.config
+        Variables._load = classmethod(lambda cls: config)
+        crashplan.Crashplan.BASE_API_URL = self.crashplan.url + "/api/"
+        transmission_client._shared_pool = transmission_client.TransmissionClientPool(
+            '127.0.0.1', self.transmission.port)
+        bot.metrics_store = MetricsStore(os.path.join(self.directory, 'metrics'))
+        shell.command_executor = InlineExecutor()
+
+    def _chat_id(self):
+        with self._chat_lock:
+            self._next_chat_id += 1
+            return self._next_chat_id
+
+    def run_chat(self, texts, sender):
+        conversation = self.conversation_class(self._chat_id(), sender)
+        for index, text in enumerate(texts):
+            msg = {'message_id': index + 1, 'date': int(time.time()), 'text': text,
+                   'from': {'id': 1, 'username': USERNAME, 'first_name': USERNAME},
+                   'chat': {'id': conversation.chat_id, 'type': 'private'}}
+            try:
+                conversation.on_chat_message(msg)
+            except self.stop_listening:
+                return
+
+    def run_thingspeak(self):
+        from thingspeak_spool import SampleSpool, ThingSpeakBulkUploader
+
+        spool = SampleSpool(os.path.join(self.directory, 'spool', 'speedtest.jsonl'))
+        spool.append({'field1': 12.5, 'field2': 95.1, 'field3': 20.4})
+        uploader = ThingSpeakBulkUploader(1, 'benchmark', self.thingspeak.url)
+        spool.flush(uploader.upload, uploader.BATCH_SIZE)
+
+    def run(self, name, scenario, iterations, concurrency):
+        kind, texts, config = scenario
+        overrides = {key: self.fakes[value].url if value in self.fakes else value for key, value in config.items()}
+        previous = {key: self.config.get(key) for key in overrides}
+        self.config.update(overrides)
+        try:
+            return self._run(name, kind, texts, iterations, concurrency)
+        finally:
+            for key, value in previous.items():
+                if value is None:
+                    self.config.pop(key, None)
+                else:
+                    self.config[key] = value
+
+    def _run(self, name, kind, texts, iterations, concurrency):
+        from instrumentation import LatencyHistogram, instrumentation
+
+        latencies = LatencyHistogram()
+        lock = threading.Lock()
+        totals = {'failed': 0, 'telegram_calls': 0}
+        failures = []
+        backend_calls_before = self._backend_calls(instrumentation)
+        requests_before = sum(server.request_count() for server in self.servers)
+
+        def iteration(index):
+            sender = FakeSender()
+            self.error_counter.reset()
+            failure = None
+            started_at = time.perf_counter()
+            try:
+                if kind == 'chat':
+                    self.run_chat(texts, sender)
+                else:
+                    self.run_thingspeak()
+            except Exception as e:
+                failure = "{type}: {error}".format(type=type(e).__name__, error=e)
+            seconds = time.perf_counter() - started_at
+            if failure is None and sender.failures:
+                failure = sender.failures[0]
+            if failure is None and self.error_counter.errors():
+                failure = "{count} errors logged".format(count=self.error_counter.errors())
+            with lock:
+                latencies.record(seconds)
+                totals['telegram_calls'] += sender.calls
+                if failure is not None:
+                    totals['failed'] += 1
+                    failures.append(failure)
+
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(iteration, range(iterations)))
+        elapsed = time.perf_counter() - started_at
+
+        return {
+            'scenario': name,
+            'runs': iterations,
+            'failed_runs': totals['failed'],
+            'first_failure': failures[0] if failures else None,
+            'runs_per_second': iterations / elapsed,
+            'p50_ms': latencies.percentile(50) * 1000,
+            'p95_ms': latencies.percentile(95) * 1000,
+            'p99_ms': latencies.percentile(99) * 1000,
+            'backend_calls_per_run': (self._backend_calls(instrumentation) - backend_calls_before) / iterations,
+            'http_requests_per_run': (sum(server.request_count() for server in self.servers) -
+                                      requests_before) / iterations,
+            'telegram_calls_per_run': totals['telegram_calls'] / iterations,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+
+    def _backend_calls(self, instrumentation):
+        return sum(histogram.count for (kind, name), histogram in instrumentation.histograms() if kind == 'backend')
+
+    def close(self):
+        logging.getLogger().removeHandler(self.error_counter)
+        for server in self.servers:
+            server.close()
+
+
+def print_table(results):
+    columns = (('scenario', '{:<21}', 21), ('runs/s', '{:>9.1f}', 9), ('failed', '{:>8d}', 8),
+               ('p50 ms', '{:>9.1f}', 9), ('p95 ms', '{:>9.1f}', 9), ('p99 ms', '{:>9.1f}', 9),
+               ('backend', '{:>9.1f}', 9), ('http', '{:>8.1f}', 8), ('telegram', '{:>9.1f}', 9),
+               ('rss MB', '{:>8.1f}', 8))
+    keys = ('scenario', 'runs_per_second', 'failed_runs', 'p50_ms', 'p95_ms', 'p99_ms', 'backend_calls_per_run',
+            'http_requests_per_run', 'telegram_calls_per_run', 'peak_rss_mb')
+    header = ''.join(('{:<' if index == 0 else '{:>') + str(width) + '}'
+                     for index, (name, fmt, width) in enumerate(columns))
+    print(header.format(*[name for name, fmt, width in columns]))
+    for result in results:
+        print(''.join(fmt.format(result[key]) for (name, fmt, width), key in zip(columns, keys)))
+    for result in results:
+        if result['failed_runs']:
+            print("{scenario}: {first_failure}".format(**result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the bot against local fakes of every backend")
+    parser.add_argument('--torrents', type=int, default=500, help="torrents seeded in the fake Transmission")
+    parser.add_argument('--tasks', type=int, default=50, help="tasks printed by the fake flexget")
+    parser.add_argument('--iterations', type=int, default=50, help="conversations per scenario")
+    parser.add_argument('--concurrency', type=int, default=4, help="conversations running at once")
+    parser.add_argument('--scenario', action='append', choices=[name for name, scenario in SCENARIOS],
+                        help="scenarios to run, all of them by default")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON lines")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='homebot-benchmark-')
+    benchmark = Benchmark(args.torrents, args.tasks, directory)
+    try:
+        results = []
+        for name, scenario in SCENARIOS:
+            if args.scenario and name not in args.scenario:
+                continue
+            result = benchmark.run(name, scenario, args.iterations, args.concurrency)
+            results.append(result)
+            if args.json:
+                print(json.dumps(result))
+        if not args.json:
+            print_table(results)
+    finally:
+        benchmark.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,169 +1,236 @@
-import os
 import telepot
-from subprocess import CalledProcessError, check_output, STDOUT
-import tempfile
+import telepot.exception
+import telepot.helper
 import logging
-import logging.handlers
-from telepot.delegate import per_chat_id, create_open, pave_event_space
-import transmissionrpc
-import math
-import json
-from datetime import datetime
-from crashplan import Crashplan
+from access import ADMIN, VIEWER, AccessConfigError, access_list
+from torrent_selector import parse_selection, split_by_node
+import time
+from datetime import datetime, timedelta
+from flexget_api import FlexgetAPI, FlexgetAPIError, FlexgetUnavailableError
+from flexget_status import FlexgetStatusError, parse_status_table
 from variables import Variables
-import psutil
-import re
-
-rootLogger = logging.getLogger('')
-rootLogger.setLevel(logging.INFO)
-
-
-def human_readable_timedelta(timedelta, precision=2):
-    units = ('year', 'day', 'hour', 'minute', 'second', 'microsecond')
-
-    delta = abs(timedelta)
-    delta_dict = {
-        'year': int(delta.days / 365),
-        'day': int(delta.days % 365),
-        'hour': int(delta.seconds / 3600),
-        'minute': int(delta.seconds / 60) % 60,
-        'second': delta.seconds % 60,
-    }
-
-    hlist = []
-    count = 0
-
-    for unit in units:
-        if count >= precision:
-            break # met precision
-        unit_value = delta_dict[unit]
-        if unit_value == 0:
-            continue # skip 0's
-        s = '' if unit_value == 1 else 's' # handle plurals
-        hlist.append('{} {}{}'.format(delta_dict[unit], unit, s))
-        count += 1
-
-    return format(', '.join(hlist)) + " ago"
-
-
-def human_readable_file_size(size):
-    if size == 0:
-        return '0B'
-    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-    i = int(math.floor(math.log(size, 1024)))
-    p = math.pow(1024, i)
-    s = round(size / p, 2)
-    return '%s %s' % (s, size_name[i])
+from messaging import ThrottledSender, chat_bucket, send_paged
+from snapshots import snapshot_store
+from metrics import downsample, metrics_store, parse_period
+from metrics import SPEEDTEST_DOWNLOAD_SERIES, SPEEDTEST_PING_SERIES, SPEEDTEST_UPLOAD_SERIES
+from shell import cancel_shell_commands, run_shell_command, submit_shell_command_reply
+from disk_report import disk_report
+from nodes import NodeConfigError, node_registry
+from rendering import PARSE_MODE, Template, escape, file_size, time_ago
+from command_router import CommandRouter, arg
+from instrumentation import instrumentation, start_json_log, start_prometheus_exporter
+from log_pipeline import configure_log
+from lazy_modules import transmissionrpc
+from sessions import SESSION_IDLE_SECONDS, SessionStore
+from workers import MAX_PENDING, WORKERS, WorkerPool, backend_limits
+import shlex
+from contextlib import contextmanager
+
+DISK_FREE_SERIES = "disk.free."
+TORRENTS_RATE_DOWNLOAD_SERIES = "torrents.rate_download"
+DEFAULT_HISTORY_PERIOD = "7d"
+SPARKLINE_POINTS = 24
+TORRENT_SELECTION_HELP = ("Please provide torrent IDs (1-50,72, or node:1-50 with several nodes) and/or filters "
+                          "(status:stopped name~regex ratio>2) or /cancel")
+SPARKLINE_CHARS = "\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+
+# Status replies are MarkdownV2, see rendering.py
+TORRENT_TEMPLATE = Template('\\[{key}\\] *{name}*\n{status} \\| Size: {size} \\| {progress}%\nD/L:{rate} \\| ETA:{eta}')
+ADDED_TORRENT_TEMPLATE = Template('\\[{key}\\] *{name}*')
+FLEXGET_TASK_TEMPLATE = Template('*{name}*\nLast run: {last_run}\nLast success: {last_success}')
+CRASHPLAN_COMPUTER_TEMPLATE = Template('*{name}* Done: {done}% \\| Last completed: {last_completed} \\| '
+                                       'Last connected: {last_connected} \\| Backup size: {size}')
+CRASHPLAN_SUBSCRIPTION_TEMPLATE = Template('*{name}* Expires {expiration}')
+DISK_USAGE_TEMPLATE = Template('\\[{mount_point}\\] *Total*: {total} *Free*: {free} \\({free_percentage}%\\)')
+DISK_ERROR_TEMPLATE = Template('\\[{mount_point}\\] *{error}*')
+DISK_FREE_TEMPLATE = Template('\\[{mount_point}\\] *Free*: {free}')
+DISK_TREND_TEMPLATE = Template('\\[{mount_point}\\] *Free*: {free} \\({change}\\)\n{sparkline}')
+NODE_TEMPLATE = Template('*{node}*')
+NODE_ERROR_TEMPLATE = Template('*{node}*: {error}')
 
 
 class Flexget:
+    def __init__(self, node=None):
+        variables = Variables()
+        # Only the local node has a flexget CLI to fall back to
+        self.local = node is None or node.local
+        if self.local:
+            api_url, api_token = variables.get("flexget_api_url"), variables.get("flexget_api_token")
+            self.api = FlexgetAPI(api_url, api_token) if api_url else None
+        else:
+            api_url, api_token = node.flexget_api_url, node.flexget_api_token
+            self.api = FlexgetAPI(api_url, api_token, timeout=node.timeout,
+                                  backend="flexget:" + node.name) if api_url else None
+
     def _run_flexget_command(self, flexget_command):
         flexget_path = Variables()["flexget_path"]
-        return_code, result = run_shell_command(flexget_path +  " " + flexget_command)
+        with self._cli_slot():
+            return_code, result = run_shell_command(flexget_path +  " " + flexget_command)
         if result and result.startswith("There is a FlexGet process already running"):
             result = '\n'.join(result.splitlines()[1:])
         return return_code, result
 
     def list(self):
+        if self.api:
+            try:
+                return self._statuses_to_markdown(self.api.status())
+            except FlexgetUnavailableError:
+                if not self.local:
+                    return ["Flexget daemon is unavailable"]
+                logging.exception("Flexget daemon is unavailable, falling back to the CLI")
+            except FlexgetAPIError as e:
+                logging.error("Flexget status failed: " + str(e))
+                return [escape("Flexget status failed: " + str(e))]
+        elif not self.local:
+            return ["No Flexget API configured"]
+
         return_code, result = self._run_flexget_command("status --porcelain")
         if return_code != 0:
-            return result
-
-        statuses = self._parse_flexget_status(result)
-        format_tasks = [self._status_to_markdown(s) for s in statuses]
-        return format_tasks
-
-    def _parse_flexget_status(self, status_result):
-        lines = status_result.splitlines()
-        headers = lines[0].split("|")
-        headers = [item.strip() for item in headers]
-        status_lines = lines[1:]
-        tasks_data = []
-        for line in status_lines:
-            task_data = {}
-            for index, field_data in enumerate(line.split("|")):
-                task_data[headers[index]] = field_data.strip()
-            tasks_data.append(task_data)
-        return tasks_data
-
-    def _status_to_markdown(self, status_data):
-        task_name = status_data["Task"]
-        last_exec = status_data["Last execution"]
-        last_success = status_data["Last success"]
-
-        if last_exec != "-":
-            last_exec_date = datetime.strptime(last_exec, "%Y-%m-%d %H:%M")
-            last_exec_desc = human_readable_timedelta(datetime.now() - last_exec_date)
-        else:
-            last_exec_desc = "Never"
+            return [escape(result)]
 
-        if last_success != "-":
-            last_success_date = datetime.strptime(last_success, "%Y-%m-%d %H:%M")
-            last_success_desc = human_readable_timedelta(datetime.now() - last_success_date)
-        else:
-            last_success_desc = "Never"
+        try:
+            return self._statuses_to_markdown(parse_status_table(result))
+        except FlexgetStatusError as e:
+            logging.warning(str(e))
+            return [escape(str(e))]
+
+    def _statuses_to_markdown(self, statuses):
+        if not statuses:
+            return [escape("No Flexget tasks")]
+        now = datetime.now()
+        with instrumentation.span("format", "flexget"):
+            return [self._status_to_markdown(status, now) for status in statuses]
+
+    def _status_to_markdown(self, status, now):
+        return FLEXGET_TASK_TEMPLATE.render(name=status.name, last_run=self._time_ago(status.last_execution, now),
+                                            last_success=self._time_ago(status.last_success, now))
+
+    def _time_ago(self, time, now):
+        if time is None:
+            return "Never"
+        return time_ago(now - time)
+
+    @contextmanager
+    def _cli_slot(self):
+        with backend_limits.slot("flexget"), instrumentation.span("backend", "flexget.cli"):
+            yield
+
+    def execute(self, task_name, bot):
+        """
+        Returns the reply, or None when the CLI runs and streams its output to bot.
+        """
+        if self.api:
+            try:
+                started = self.api.execute(task_name)
+                return "Started " + ", ".join(started) if started else "No matching tasks"
+            except FlexgetUnavailableError:
+                if not self.local:
+                    return "Flexget daemon is unavailable"
+                logging.exception("Flexget daemon is unavailable, falling back to the CLI")
+            except FlexgetAPIError as e:
+                logging.error("Flexget execute failed: " + str(e))
+                return "Flexget execute failed: " + str(e)
+        elif not self.local:
+            return "No Flexget API configured"
+
+        # Runs can take minutes, so they're streamed and can be stopped with /cancel
+        submit_shell_command_reply(Variables()["flexget_path"] + " execute --tasks " + shlex.quote(task_name), bot,
+                                   guard=self._cli_slot)
+        return None
 
-        return "*{task_name}*\nLast run: {last_exec_desc}\nLast success: {last_success_desc}".format(**locals())
 
-    def execute(self, task_name):
-        return task_name
+class Transmission:
+    def __init__(self, pool=None, node=None):
+        from transmission_client import shared_pool
 
+        self.node = node
+        self.pool = pool or (node.transmission_pool() if node else shared_pool())
 
-class Transmission:
     def connect(self):
-        return transmissionrpc.Client()
+        return self.pool.client()
+
+    def _torrent_values(self, torrent):
+        return {'key': self._key(torrent), 'name': torrent.name, 'status': torrent.status,
+                'size': file_size(torrent.totalSize), 'progress': round(torrent.progress, 2),
+                'rate': file_size(torrent.rateDownload) + "/s", 'eta': torrent.format_eta()}
 
-    def _torrent_to_markdown(self, torrent):
-        return '\[{id}] *{name}*\n{status} | Size: {size} | {progress}%\nD/L:{dl_rate} | ETA:{eta}'\
-            .format(id=torrent.id, name=torrent.name, status=torrent.status,
-                    size=human_readable_file_size(torrent.totalSize), progress=round(torrent.progress, 2),
-                    eta=torrent.format_eta(), dl_rate=(human_readable_file_size(torrent.rateDownload))+"/s")
+    def _key(self, torrent):
+        if self.node is not None and self.node.tag:
+            return "{node}:{id}".format(node=self.node.tag, id=torrent.id)
+        return torrent.id
 
     def list(self):
         try:
-            c = self.connect()
-            torrents = c.get_torrents()
+            torrents = self.pool.torrents.list()
         except transmissionrpc.TransmissionError:
             logging.error("Failed to connect to transmission")
             return ["Failed to connect to transmission"]
 
+        series = TORRENTS_RATE_DOWNLOAD_SERIES
+        if self.node is not None and not self.node.local:
+            series += "." + self.node.name
+        record_metric(series, sum(t.rateDownload for t in torrents))
         if not torrents:
             return ["No torrents here"]
-
-        format_torrents = [self._torrent_to_markdown(t) for t in torrents]
-        return format_torrents
-
-    def add(self, url):
+        return self._torrents_to_markdown(torrents)
+
+    def _torrents_to_markdown(self, torrents):
+        # Rows are rendered as they're packed into messages, a page of a long list only renders its own rows
+        with instrumentation.span("format", "torrents"):
+            yield from TORRENT_TEMPLATE.render_rows(self._torrent_values(torrent) for torrent in torrents)
+
+    def add(self, text):
+        added = []
+        failed = []
+        for url in text.split():
+            try:
+                new_torrent = self.pool.call("add_torrent", url)
+                added.append(ADDED_TORRENT_TEMPLATE.render(key=self._key(new_torrent), name=new_torrent.name))
+            except transmissionrpc.TransmissionError as e:
+                if e.original is not None:
+                    logging.error("Failed to connect to transmission")
+                    return "Failed to connect to transmission"
+                logging.error("Failed to add torrent {url}: {error}".format(url=url, error=e))
+                failed.append(url)
+
+        if len(added) == 1 and not failed:
+            return "Added new torrent : " + added[0]
+        summary = ["Added {count} torrents".format(count=len(added))] + added
+        if failed:
+            summary.append("Failed to add {count} torrents".format(count=len(failed)))
+        return "\n".join(summary)
+
+    def select(self, selection):
+        """
+        Returns the ids of the torrents matching a selection like '1-50,72 status:stopped'.
+        Raises ValueError on bad selections.
+        """
+        predicate = parse_selection(selection)
+        return [torrent.id for torrent in self.pool.torrents.list() if predicate(torrent)]
+
+    def start(self, selection):
+        return self._update_selection("start_torrent", selection, "Started")
+
+    def stop(self, selection):
+        return self._update_selection("stop_torrent", selection, "Stopped")
+
+    def _update_selection(self, method, selection, done):
         try:
-            c = self.connect()
-            new_torrent = c.add_torrent(url)
-            return "Added new torrent : \[{id}] *{name}*".format(id=new_torrent.id, name=new_torrent.name)
+            torrent_ids = self.select(selection)
+            if not torrent_ids:
+                return "No torrents match " + selection
+            self.pool.call(method, torrent_ids)
+            return "{done} {count} torrents".format(done=done, count=len(torrent_ids))
         except transmissionrpc.TransmissionError:
             logging.error("Failed to connect to transmission")
             return "Failed to connect to transmission"
 
-    def start(self, torrent_id):
-        try:
-            c = self.connect()
-            c.start_torrent([torrent_id])
-            return "Ok"
-        except transmissionrpc.TransmissionError:
-            logging.error("Failed to connect to transmission")
-            return "Failed to connect to transmission"
-
-    def stop(self, torrent_id):
-        try:
-            c = self.connect()
-            c.stop_torrent([torrent_id])
-            return "Ok"
-        except transmissionrpc.TransmissionError:
-            logging.error("Failed to connect to transmission")
-            return "Failed to connect to transmission"
+    def session_stats(self):
+        return self.pool.rpc("session-stats")
 
     def clean(self):
         try:
-            c = self.connect()
-            torrents = c.get_torrents()
+            torrents = self.pool.torrents.list()
             remove_ids = []
             for torrent in torrents:
                 if torrent.leftUntilDone == 0:
@@ -172,52 +239,286 @@ class Transmission:
             if not remove_ids:
                 return "No torrents to remove"
             else:
-                c.remove_torrent(remove_ids)
+                self.pool.call("remove_torrent", remove_ids)
+                self.pool.torrents.discard(remove_ids)
                 return "Removed {number} torrents".format(number=len(remove_ids))
         except transmissionrpc.TransmissionError:
             logging.error("Failed to connect to transmission")
             return "Failed to connect to transmission"
 
 
-def join_path_to_script_directory(path):
-    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+class CrashplanStatus:
+    def list(self):
+        from crashplan import Crashplan
+
+        variables = Variables()
+        crashplan = Crashplan.shared(variables["crashplan_user"], variables["crashplan_password"])
+        subscription, computers = crashplan.get_subscription_and_computers()
+        with instrumentation.span("format", "crashplan"):
+            return [self._subscription_to_markdown(subscription)] + [self._computer_to_markdown(c) for c in computers]
+
+    def _computer_to_markdown(self, computer):
+        return CRASHPLAN_COMPUTER_TEMPLATE.render(name=computer.name, done=computer.percentComplete,
+                                                  last_completed=computer.last_completed.humanize(),
+                                                  last_connected=computer.last_connected.humanize(),
+                                                  size=file_size(computer.total_backup_size))
 
+    def _subscription_to_markdown(self, subscription):
+        if subscription is None:
+            return "No active subscription"
+        return CRASHPLAN_SUBSCRIPTION_TEMPLATE.render(name=subscription.name,
+                                                      expiration=subscription.expirationDate.humanize())
 
-def configure_log():
-    root = logging.getLogger()
-    log_file_name = join_path_to_script_directory("logs/bot.log")
-    h = logging.handlers.RotatingFileHandler(log_file_name, maxBytes=1024*1024, backupCount=5)
-    f = logging.Formatter('%(asctime)s %(name)s %(levelname)-8s %(message)s')
-    h.setFormatter(f)
-    root.addHandler(h)
 
+class Disks:
+    def __init__(self, node=None):
+        self.node = node
 
-def text_to_tempfile(text):
-    fd, path = tempfile.mkstemp()
-    with open(path, 'w') as f:
-        f.write(text)
-    os.close(fd)
-    return path
+    def list(self):
+        if self.node is not None and not self.node.local:
+            return self._download_dir_free_space()
+        disks = []
+        for mount_point, usage, error in disk_report.usages(Variables()["mountpoint_regex"]):
+            if usage is None:
+                disks.append(DISK_ERROR_TEMPLATE.render(mount_point=mount_point, error=error.capitalize()))
+            else:
+                record_metric(DISK_FREE_SERIES + mount_point, usage.free)
+                disks.append(self._disk_usage_to_markdown(mount_point, usage))
+        return disks or ["No matching mount points"]
+
+    def trend(self, period):
+        now = time.time()
+        trends = []
+        for series in metrics_store.series(DISK_FREE_SERIES):
+            buckets = metrics_store.query(series, now - period, now)
+            if not buckets:
+                continue
+            change = buckets[-1].mean - buckets[0].mean
+            trends.append(DISK_TREND_TEMPLATE.render(
+                mount_point=series[len(DISK_FREE_SERIES):], free=file_size(int(buckets[-1].mean)),
+                change=('+' if change >= 0 else '-') + file_size(int(abs(change))),
+                sparkline=sparkline([b.mean for b in downsample(buckets, SPARKLINE_POINTS)])))
+        return trends or ["No disk history for this period"]
+
+    def _download_dir_free_space(self):
+        # Remote nodes only expose their disks through Transmission, which knows the free space of its download dir
+        pool = self.node.transmission_pool()
+        download_dir = pool.rpc("session-get")["download-dir"]
+        free = pool.rpc("free-space", {"path": download_dir})["size-bytes"]
+        return [DISK_FREE_TEMPLATE.render(mount_point=download_dir, free=file_size(free))]
 
+    def _disk_usage_to_markdown(self, mount_point, disk_usage):
+        return DISK_USAGE_TEMPLATE.render(mount_point=mount_point, total=file_size(disk_usage.total),
+                                          free=file_size(disk_usage.free),
+                                          free_percentage=round((100 - disk_usage.percent), 2))
+
+
+def merge_node_messages(results):
+    """
+    Yields the messages of every node, each node's under its name when there are several nodes.
+    """
+    for result in results:
+        if result.error is not None:
+            yield NODE_ERROR_TEMPLATE.render(node=result.node.tag, error=result.error)
+            continue
+        if result.node.tag:
+            yield NODE_TEMPLATE.render(node=result.node.tag)
+        yield from result.value
+
+
+def merge_node_replies(results):
+    replies = []
+    for result in results:
+        reply = result.value if result.error is None else result.error
+        replies.append("{node}: {reply}".format(node=result.node.tag, reply=reply) if result.node.tag else reply)
+    return "\n".join(replies)
+
+
+class TransmissionNodes:
+    """
+    Transmission on every node, torrents are keyed node:id when there are several nodes.
+    """
+    def list(self):
+        return merge_node_messages(node_registry.fan_out(lambda node: Transmission(node=node).list()))
 
-def run_shell_command(command):
-    try:
-        output = check_output(command, stderr=STDOUT, shell=True)
-        return_code = 0
-    except CalledProcessError as e:
-        output = e.output
-        return_code = e.returncode
-    return return_code, str(output, 'utf-8')
-
-
-def run_shell_command_and_reply_answer(command, sender):
-    return_code, output = run_shell_command(command)
-    if len(output) > 4096:
-        temp_file_path = text_to_tempfile(output)
-        sender.sendDocument(open(temp_file_path, 'rb'))
-        os.remove(temp_file_path)
+    def add(self, text):
+        node, magnets = node_registry.pop_node_term(text)
+        return Transmission(node=node).add(magnets)
+
+    def start(self, selection):
+        return self._update_selection("start", selection)
+
+    def stop(self, selection):
+        return self._update_selection("stop", selection)
+
+    def _update_selection(self, action, selection):
+        nodes = {node.name: node for node in node_registry.nodes()}
+        selections = split_by_node(selection, list(nodes))
+        # Bad selections are reported before any node is touched
+        for node_selection in selections.values():
+            parse_selection(node_selection)
+        results = node_registry.fan_out(lambda node: getattr(Transmission(node=node), action)(selections[node.name]),
+                                        [nodes[name] for name in selections])
+        return merge_node_replies(results)
+
+    def clean(self):
+        return merge_node_replies(node_registry.fan_out(lambda node: Transmission(node=node).clean()))
+
+
+class FlexgetNodes:
+    def list(self):
+        return merge_node_messages(node_registry.fan_out(lambda node: Flexget(node).list()))
+
+    def execute(self, text, bot):
+        node, task_name = node_registry.pop_node_term(text)
+        if not task_name:
+            return "Please provide a task name"
+        return Flexget(node).execute(task_name, bot)
+
+
+class DiskNodes:
+    def list(self):
+        return merge_node_messages(node_registry.fan_out(lambda node: Disks(node).list()))
+
+
+class TransmissionHealth:
+    PERIOD = timedelta(days=1)
+    RESTARTS_TO_SHOW = 5
+
+    def list(self):
+        from transmission_watchdog import HealthHistory, percentile
+
+        history = HealthHistory()
+        now = datetime.now()
+        probes = history.probes_since(time.time() - self.PERIOD.total_seconds())
+        if not probes:
+            return ["No watchdog probes in the last day"]
+
+        latencies = [latency for probe_time, latency in probes if latency is not None]
+        health = ["*Transmission RPC* (last day)\nProbes: {count} | Failed: {failed}".format(
+            count=len(probes), failed=len(probes) - len(latencies))]
+        if latencies:
+            health.append("Latency p50: {p50} | p95: {p95} | p99: {p99}".format(
+                **{name: self._milliseconds(percentile(latencies, percent))
+                   for name, percent in (("p50", 50), ("p95", 95), ("p99", 99))}))
+        restarts = history.restarts[-self.RESTARTS_TO_SHOW:]
+        if restarts:
+            health.append("*Restarts*:\n" + "\n".join(
+                time_ago(now - datetime.fromtimestamp(restart)) for restart in reversed(restarts)))
+        else:
+            health.append("No restarts")
+        return ["\n".join(health)]
+
+    def _milliseconds(self, seconds):
+        return "{ms:.0f}ms".format(ms=seconds * 1000)
+
+
+class SpeedtestHistory:
+    SERIES = (("Ping", SPEEDTEST_PING_SERIES, "ms"),
+              ("Download", SPEEDTEST_DOWNLOAD_SERIES, "Mbit/s"),
+              ("Upload", SPEEDTEST_UPLOAD_SERIES, "Mbit/s"))
+
+    def list(self, period):
+        now = time.time()
+        history = []
+        for title, series, unit in self.SERIES:
+            buckets = metrics_store.query(series, now - period, now)
+            if not buckets:
+                continue
+            mean = sum(b.total for b in buckets) / sum(b.count for b in buckets)
+            history.append("*{title}*: avg {mean:.1f} min {low:.1f} max {high:.1f} {unit}\n{sparkline}".format(
+                title=title, mean=mean, low=min(b.min for b in buckets), high=max(b.max for b in buckets),
+                unit=unit, sparkline=sparkline([b.mean for b in downsample(buckets, SPARKLINE_POINTS)])))
+        return history or ["No speedtest history for this period"]
+
+
+class LatencyStats:
+    KINDS = (("command", "Commands"), ("backend", "Backends"), ("queue", "Queue waits"), ("format", "Formatting"),
+             ("telegram", "Telegram"))
+
+    def list(self):
+        lines_by_kind = {}
+        for (kind, name), histogram in instrumentation.histograms():
+            lines_by_kind.setdefault(kind, []).append(self._histogram_to_markdown(name, histogram))
+        if not lines_by_kind:
+            return ["Nothing timed yet"]
+
+        messages = ["*{title}*\n{lines}".format(title=title, lines="\n".join(lines_by_kind[kind]))
+                    for kind, title in self.KINDS if kind in lines_by_kind]
+        started = datetime.fromtimestamp(instrumentation.started_at)
+        return messages + ["Counting since " + started.strftime("%Y-%m-%d %H:%M")]
+
+    def _histogram_to_markdown(self, name, histogram):
+        return "`{name}` {count}x p50 {p50} p95 {p95} p99 {p99}".format(
+            name=name, count=histogram.count, p50=self._duration(histogram.percentile(50)),
+            p95=self._duration(histogram.percentile(95)), p99=self._duration(histogram.percentile(99)))
+
+    def _duration(self, seconds):
+        if seconds < 1:
+            return "{ms:.0f}ms".format(ms=seconds * 1000)
+        return "{seconds:.2f}s".format(seconds=seconds)
+
+
+SNAPSHOT_SOURCES = {
+    "torrents": (lambda: list(TransmissionNodes().list()), 30),
+    "flexget": (lambda: list(FlexgetNodes().list()), 300),
+    "crashplan": (lambda: CrashplanStatus().list(), 1800),
+    "disk": (lambda: list(DiskNodes().list()), 300),
+}
+
+
+def start_snapshot_poller():
+    """
+    Starts refreshing every snapshot source in the background, when enabled with snapshot_poller=YES.
+    Intervals can be overridden with snapshot_interval_<name> (seconds).
+    """
+    variables = Variables()
+    if not variables.get_bool("snapshot_poller"):
+        return
+    for name, (refresh, interval) in SNAPSHOT_SOURCES.items():
+        snapshot_store.register(name, refresh, variables.get_int("snapshot_interval_" + name, interval))
+    snapshot_store.start()
+
+
+def start_stats_exporters():
+    """
+    Exports the latency histograms when enabled: stats_prometheus_port serves them on localhost for Prometheus,
+    stats_log_interval (seconds) logs them as JSON lines.
+    """
+    variables = Variables()
+    port = variables.get_int("stats_prometheus_port", 0)
+    if port:
+        start_prometheus_exporter(port)
+    interval = variables.get_int("stats_log_interval", 0)
+    if interval:
+        start_json_log(interval)
+
+
+def current_messages(name, compute):
+    """
+    Returns the background snapshot of name with its age when there is one, computes it live otherwise.
+    """
+    snapshot = snapshot_store.get(name)
+    if snapshot is None:
+        return compute()
+    if snapshot.age() < 1:
+        age = "Updated just now"
     else:
-        sender.sendMessage(output)
+        age = "Updated " + time_ago(timedelta(seconds=snapshot.age()))
+    return snapshot.value + [escape(age + " - /refresh to update")]
+
+
+def record_metric(series, value):
+    try:
+        metrics_store.record(series, value)
+    except OSError:
+        logging.exception("Failed to record " + series)
+
+
+def sparkline(values):
+    low = min(values)
+    span = (max(values) - low) or 1
+    return ''.join(SPARKLINE_CHARS[int((value - low) / span * (len(SPARKLINE_CHARS) - 1))] for value in values)
 
 
 def to_int(s):
@@ -230,9 +531,13 @@ def to_int(s):
 class CommandHandler:
     def __init__(self, bot, text):
         self.bot = bot
-        self.send_command_help_message()
         self.command_handler = self
         self.text = text
+        # Arguments given along with the command are handled right away, otherwise they're asked for
+        if text:
+            self.handle_command(text)
+        else:
+            self.send_command_help_message()
 
     def handle_command(self, text):
         pass
@@ -246,92 +551,63 @@ class CrashplanCommandHandler:
         self.bot = bot
         self.text = text
 
-        variables = Variables()
-
-        crashplan = Crashplan(variables["crashplan_user"], variables["crashplan_password"])
-        subscription = crashplan.get_subscription()
-
-        computers = crashplan.computers()
-        self.bot.sender.sendMessage(self._subscription_to_markdown(subscription), parse_mode='Markdown')
-        for computer in computers:
-            self.bot.sender.sendMessage(self._computer_to_markdown(computer), parse_mode='Markdown')
-
+        send_paged(bot.sender, current_messages("crashplan", CrashplanStatus().list), parse_mode=PARSE_MODE)
         bot.close()
 
-    def _computer_to_markdown(self, computer):
-        name = computer.name
-        last_connected = computer.last_connected.humanize()
-        total_backup_size = human_readable_file_size(computer.total_backup_size)
-        percentComplete = computer.percentComplete
-        last_completed = computer.last_completed.humanize()
-
-        return ("*{name}* Done: {percentComplete}% | Last completed: {last_completed} | "
-                "Last connected: {last_connected} | Backup size: {total_backup_size}").format(**locals())
-
-    def _subscription_to_markdown(self, subscription):
-        name = subscription.name
-        expiration = subscription.expirationDate.humanize()
-        return "*{name}* Expires {expiration}".format(**locals())
-
 
 class SystemRebootCommandHandler:
     def __init__(self, bot, text):
-        run_shell_command_and_reply_answer("/sbin/reboot", bot.sender)
+        submit_shell_command_reply("/sbin/reboot", bot)
         bot.close()
 
 
 class SystemDiskCommandHandler(CommandHandler):
     def __init__(self, bot, text):
-        for partition in psutil.disk_partitions(True):
-            if not re.fullmatch(Variables()["mountpoint_regex"], partition.mountpoint):
-                continue
-            usage = psutil.disk_usage(partition.mountpoint)
-            bot.sender.sendMessage(self._disk_usage_to_markdown(partition.mountpoint, usage), parse_mode='Markdown')
+        split_text = text.split()
+        if split_text and split_text[0].lower() == "trend":
+            period = parse_period(" ".join(split_text[1:]) or DEFAULT_HISTORY_PERIOD)
+            if period is None:
+                bot.sender.sendMessage("Please provide a period like 12h, 7d or 4w")
+            else:
+                send_paged(bot.sender, Disks().trend(period), parse_mode=PARSE_MODE)
+        else:
+            send_paged(bot.sender, current_messages("disk", DiskNodes().list), parse_mode=PARSE_MODE)
         bot.close()
 
-    def _disk_usage_to_markdown(self, mount_point, disk_usage):
-        return '\[{mount_point}] *Total*: {total_size} *Free*: {free} ({free_percentage}%)'\
-            .format(mount_point=mount_point, total_size=human_readable_file_size(disk_usage.total),
-                    free=human_readable_file_size(disk_usage.free),
-                    free_percentage=round((100 - disk_usage.percent), 2))
-
 
-class SystemCommandHandler:
+class SystemImportsCommandHandler:
     def __init__(self, bot, text):
-        self.bot = bot
-        self.send_command_help_message()
+        from import_report import report
+
+        try:
+            send_paged(bot.sender, ["\n".join(report(text or "bot"))], parse_mode=None)
+        except (ImportError, ValueError) as e:
+            bot.sender.sendMessage(str(e))
+
         self.text = text
-        self.command_handler = None
+        bot.close()
 
-    def send_command_help_message(self):
-        self.bot.sender.sendMessage("System help - /disk /reboot")
 
-    def handle_command(self, text):
-        if self.command_handler:
-            self.command_handler.handle_command(text)
-            return
+class SystemStatsCommandHandler:
+    def __init__(self, bot, text):
+        send_paged(bot.sender, LatencyStats().list())
 
-        if len(text) == 0:
-            self.send_command_help_message()
-            return
+        self.text = text
+        bot.close()
 
-        split_text = text.split()
-        command = split_text[0][1:].lower()
-        command_args = " ".join(split_text[1:])
-        logging.info("received system command " + command)
-
-        if command == "disk":
-            self.command_handler = SystemDiskCommandHandler(self.bot, command_args)
-        elif command == "reboot":
-            self.command_handler = SystemRebootCommandHandler(self.bot, command_args)
-        else:
-            self.send_command_help_message()
+
+class SystemTransmissionCommandHandler:
+    def __init__(self, bot, text):
+        send_paged(bot.sender, TransmissionHealth().list())
+
+        self.text = text
+        bot.close()
 
 
 class FlexgetListCommandHandler:
     def __init__(self, bot, text):
-        for message in Flexget().list():
-            bot.sender.sendMessage(message, parse_mode='Markdown')
+        send_paged(bot.sender, current_messages("flexget", FlexgetNodes().list), to_int(text), "/flexget /list",
+                   parse_mode=PARSE_MODE)
 
         self.text = text
         bot.close()
@@ -345,43 +621,30 @@ class FlexgetExecuteCommandHandler(CommandHandler):
         if not text:
             self.send_command_help_message()
             return
-        self.bot.sender.sendMessage(Transmission.execute(text))
+        try:
+            reply = FlexgetNodes().execute(text, self.bot)
+        except ValueError as e:
+            self.bot.sender.sendMessage(str(e))
+            self.send_command_help_message()
+            return
+        if reply is not None:
+            send_paged(self.bot.sender, [reply], parse_mode=None)
         self.bot.close()
 
     def send_command_help_message(self):
         self.bot.sender.sendMessage("Please provide a task name or /cancel")
 
 
-class FlexgetCommandHandler:
+class SpeedtestHistoryCommandHandler:
     def __init__(self, bot, text):
-        self.bot = bot
-        self.send_command_help_message()
-        self.text = text
-        self.command_handler = None
-
-    def send_command_help_message(self):
-        self.bot.sender.sendMessage("Flexget help - /list /execute")
-
-    def handle_command(self, text):
-        if self.command_handler:
-            self.command_handler.handle_command(text)
-            return
-
-        if len(text) == 0:
-            self.send_command_help_message()
-            return
-
-        split_text = text.split()
-        command = split_text[0][1:].lower()
-        command_args = " ".join(split_text[1:])
-        logging.info("received flexget command " + command)
-
-        if command == "list":
-            self.command_handler = FlexgetListCommandHandler(self.bot, command_args)
-        elif command == "execute":
-            self.command_handler = FlexgetExecuteCommandHandler(self.bot, command_args)
+        period = parse_period(text or DEFAULT_HISTORY_PERIOD)
+        if period is None:
+            bot.sender.sendMessage("Please provide a period like 12h, 7d or 4w")
         else:
-            self.send_command_help_message()
+            send_paged(bot.sender, SpeedtestHistory().list(period))
+
+        self.text = text
+        bot.close()
 
 
 class TorrentAddCommandHandler(CommandHandler):
@@ -392,17 +655,25 @@ class TorrentAddCommandHandler(CommandHandler):
         if text is None or len(text) == 0:
             self.send_command_help_message()
             return
-        self.bot.sender.sendMessage(Transmission().add(text), parse_mode='Markdown')
+        try:
+            reply = TransmissionNodes().add(text)
+        except ValueError as e:
+            self.bot.sender.sendMessage(str(e))
+            self.send_command_help_message()
+            return
+        self.bot.sender.sendMessage(reply, parse_mode=PARSE_MODE)
+        snapshot_store.invalidate("torrents")
         self.bot.close()
 
     def send_command_help_message(self):
-        self.bot.sender.sendMessage("Please provide a magnet link or /cancel")
+        self.bot.sender.sendMessage("Please provide one or more magnet links, after node:NAME to pick a node, "
+                                    "or /cancel")
 
 
 class TorrentListCommandHandler:
     def __init__(self, bot, text):
-        for message in Transmission().list():
-            bot.sender.sendMessage(message, parse_mode='Markdown')
+        send_paged(bot.sender, current_messages("torrents", TransmissionNodes().list), to_int(text), "/torrents /list",
+                   parse_mode=PARSE_MODE)
 
         self.text = text
         bot.close()
@@ -413,15 +684,18 @@ class TorrentStartCommandHandler(CommandHandler):
         super(TorrentStartCommandHandler, self).__init__(bot, text)
 
     def handle_command(self, text):
-        torrent_id = to_int(text)
-        if torrent_id is None:
+        try:
+            reply = TransmissionNodes().start(text)
+        except ValueError as e:
+            self.bot.sender.sendMessage(str(e))
             self.send_command_help_message()
             return
-        self.bot.sender.sendMessage(Transmission().start(torrent_id))
+        self.bot.sender.sendMessage(reply)
+        snapshot_store.invalidate("torrents")
         self.bot.close()
 
     def send_command_help_message(self):
-        self.bot.sender.sendMessage("Please provide a torrent ID or /cancel")
+        self.bot.sender.sendMessage(TORRENT_SELECTION_HELP)
 
 
 class TorrentStopCommandHandler(CommandHandler):
@@ -429,140 +703,195 @@ class TorrentStopCommandHandler(CommandHandler):
         super(TorrentStopCommandHandler, self).__init__(bot, text)
 
     def handle_command(self, text):
-        torrent_id = to_int(text)
-        if torrent_id is None:
+        try:
+            reply = TransmissionNodes().stop(text)
+        except ValueError as e:
+            self.bot.sender.sendMessage(str(e))
             self.send_command_help_message()
             return
-        self.bot.sender.sendMessage(Transmission().stop(torrent_id))
+        self.bot.sender.sendMessage(reply)
+        snapshot_store.invalidate("torrents")
         self.bot.close()
 
     def send_command_help_message(self):
-        self.bot.sender.sendMessage("Please provide a torrent ID or /cancel")
+        self.bot.sender.sendMessage(TORRENT_SELECTION_HELP)
 
 
 class TorrentCleanCommandHandler:
     def __init__(self, bot, text):
-        bot.sender.sendMessage(Transmission().clean(), parse_mode='Markdown')
+        bot.sender.sendMessage(TransmissionNodes().clean())
+        snapshot_store.invalidate("torrents")
 
         self.text = text
         bot.close()
 
-class TorrentCommandHandler:
-    def __init__(self, bot, text):
-        self.bot = bot
-        self.send_command_help_message()
-        self.text = text
-        self.command_handler = None
-
-    def send_command_help_message(self):
-        self.bot.sender.sendMessage("Torrent help - /list /add /start /stop /clean")
-
-    def handle_command(self, text):
-        if self.command_handler:
-            self.command_handler.handle_command(text)
-            return
-
-        if len(text) == 0:
-            self.send_command_help_message()
-            return
 
-        split_text = text.split()
-        command = split_text[0][1:].lower()
-        command_args = " ".join(split_text[1:])
-        logging.info("received torrent command " + command)
-
-        if command == "add":
-            self.command_handler = TorrentAddCommandHandler(self.bot, command_args)
-        elif command == "list":
-            self.command_handler = TorrentListCommandHandler(self.bot, command_args)
-        elif command == "start":
-            self.command_handler = TorrentStartCommandHandler(self.bot, command_args)
-        elif command == "stop":
-            self.command_handler = TorrentStopCommandHandler(self.bot, command_args)
-        elif command == "clean":
-            self.command_handler = TorrentCleanCommandHandler(self.bot, command_args)
-        else:
-            self.send_command_help_message()
-
-
-class HomeBot(telepot.helper.ChatHandler):
-    def __init__(self, *args, **kwargs):
-        super(HomeBot, self).__init__(*args, **kwargs)
-        self.command_handler = self
-
-    def _on_torrent_command(self, text):
-        self.command_handler = TorrentCommandHandler(self, text)
+class RefreshCommandHandler:
+    def __init__(self, bot, text):
+        names = snapshot_store.names()
+        if not names:
+            bot.sender.sendMessage("Background refresh is disabled")
+            bot.close()
+
+        if text:
+            names = [name for name in names if name in text.split()]
+        refreshed = []
+        for name in names:
+            try:
+                snapshot = snapshot_store.refresh(name)
+                refreshed.append("{name} ({duration:.1f}s)".format(name=name, duration=snapshot.duration))
+            except Exception:
+                logging.exception("Failed to refresh " + name)
+                refreshed.append("{name} (failed)".format(name=name))
+        bot.sender.sendMessage("Refreshed: " + (", ".join(refreshed) or "nothing"))
 
-    def _on_flexget_command(self, text):
-        self.command_handler = FlexgetCommandHandler(self, text)
+        self.text = text
+        bot.close()
 
-    def _on_crashplan_command(self, text):
-        self.command_handler = CrashplanCommandHandler(self, text)
 
-    def _on_system_command(self, text):
-        self.command_handler = SystemCommandHandler(self, text)
-
-    def _on_unknown_command(self, text):
-        self.sender.sendMessage("Unknown command: " + text)
-        self.close()
+COMMANDS = CommandRouter()
+COMMANDS.group("torrents", "Torrent", aliases=("torrent",))
+COMMANDS.add("torrents list", TorrentListCommandHandler, args=(arg("page", int, optional=True),), aliases=("ls",),
+             role=VIEWER)
+COMMANDS.add("torrents add", TorrentAddCommandHandler, args=(arg("magnets", optional=True, rest=True),))
+COMMANDS.add("torrents start", TorrentStartCommandHandler, args=(arg("selection", optional=True, rest=True),))
+COMMANDS.add("torrents stop", TorrentStopCommandHandler, args=(arg("selection", optional=True, rest=True),))
+COMMANDS.add("torrents clean", TorrentCleanCommandHandler)
+COMMANDS.group("flexget", "Flexget")
+COMMANDS.add("flexget list", FlexgetListCommandHandler, args=(arg("page", int, optional=True),), aliases=("ls",),
+             role=VIEWER)
+COMMANDS.add("flexget execute", FlexgetExecuteCommandHandler, args=(arg("task", optional=True, rest=True),))
+COMMANDS.add("crashplan", CrashplanCommandHandler, role=VIEWER)
+COMMANDS.group("system", "System")
+COMMANDS.add("system disk", SystemDiskCommandHandler, args=(arg("trend", optional=True, rest=True),),
+             usage="[trend period]", aliases=("df",), role=VIEWER)
+COMMANDS.add("system transmission", SystemTransmissionCommandHandler, role=VIEWER)
+COMMANDS.add("system stats", SystemStatsCommandHandler, role=VIEWER)
+COMMANDS.add("system imports", SystemImportsCommandHandler, args=(arg("module", optional=True),), role=ADMIN)
+COMMANDS.add("system reboot", SystemRebootCommandHandler, role=ADMIN)
+COMMANDS.group("speedtest", "Speedtest")
+COMMANDS.add("speedtest history", SpeedtestHistoryCommandHandler, args=(arg("period", optional=True),),
+             role=VIEWER)
+COMMANDS.add("refresh", RefreshCommandHandler, args=(arg("names", optional=True, rest=True),))
+COMMANDS.compile()
+
+
+class HomeBotConversation:
+    """
+    Per-chat conversation logic, shared by the threaded and the asyncio bots.
+    Subclasses provide sender, chat_id, editor(sent_message) and close() and set self.command_handler = self.
+    user and role are who sent the last message and their role, see access.py. owner is the (user, role) that
+    started the command waiting for a reply, in a group chat nobody else can answer it.
+    """
+    user = None
+    role = None
+    owner = None
 
     def handle_command(self, text):
-        split_text = text.split()
-        command = split_text[0][1:].lower()
-        command_args = " ".join(split_text[1:])
-        if command == "torrents":
-            self._on_torrent_command(command_args)
-        elif command == "flexget":
-            self._on_flexget_command(command_args)
-        elif command == "crashplan":
-            self._on_crashplan_command(command_args)
-        elif command == "system":
-            self._on_system_command(command_args)
-        else:
-            self._on_unknown_command(text)
+        command_handler = COMMANDS.dispatch(self, COMMANDS.root, text)
+        if command_handler is not None:
+            self.command_handler = command_handler
+            self.owner = (self.user, self.role)
 
     def on_chat_message(self, msg):
         content_type, chat_type, chat_id = telepot.glance(msg)
-        user = msg["from"].get("username")
-        if user != "barakwei":
+        self.user = msg["from"].get("username") or msg["from"].get("id")
+        try:
+            self.role = access_list.role(msg["from"])
+        except AccessConfigError as e:
+            self._configuration_error(e)
+            return
+        if self.role is None:
             logging.error("User: {username} First: {first} Last: {last} ID: {id} is not authorized!".format(
                           username=msg["from"].get("username", ""), first=msg["from"].get("first_name", ""),
-                          last=msg["from"].get("last_name", ""), id=msg["from"].get("id", "")))
+                          last=msg["from"].get("last_name", ""), id=msg["from"].get("id", "")),
+                          extra={'event': 'unauthorized', 'chat': self.chat_id, 'user': self.user})
             self.sender.sendMessage("Not authorized!")
             self.close()
             return
-        else:
-            logging.info("User is authorized")
 
         if content_type != "text":
             # log it
             return
 
+        if self.owner is not None and self.owner != (self.user, self.role):
+            if self.owner[0] != self.user:
+                logging.warning("refused a reply to {owner}'s command".format(owner=self.owner[0]), extra={
+                                'event': 'refused', 'chat': self.chat_id, 'user': self.user, 'role': self.role})
+                self.sender.sendMessage("Waiting for {owner} to finish their command".format(owner=self.owner[0]))
+                return
+            self.sender.sendMessage("Your role changed, please start over")
+            self.close()
+
         message = msg['text'].strip()
-        logging.info("Message arrived: " + message)
+        # Commands are logged once handled, with their latency, see command_router.py
+        logging.debug("Message arrived: " + message,
+                      extra={'event': 'message', 'chat': self.chat_id, 'user': self.user})
         if message == "/cancel":
+            if cancel_shell_commands(self.chat_id):
+                self.sender.sendMessage("Cancelling running commands")
             self.close()
 
-        self.command_handler.handle_command(message)
+        try:
+            self.command_handler.handle_command(message)
+        except NodeConfigError as e:
+            self._configuration_error(e)
 
-    def on__idle(self, event):
-        self.sender.sendMessage('bye')
+    def _configuration_error(self, error):
+        logging.error("Bad configuration: " + str(error))
+        self.sender.sendMessage("Configuration error: {error}\nFix variables.cfg".format(error=error))
         self.close()
 
 
+class HomeBot(HomeBotConversation):
+    """
+    A chat's conversation, kept in the session store between messages.
+    """
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.command_handler = self
+        self.sender = ThrottledSender(telepot.helper.Sender(bot, chat_id), chat_bucket(chat_id))
+
+    def editor(self, sent_message):
+        return ThrottledSender(telepot.helper.Editor(self.bot, sent_message), chat_bucket(self.chat_id))
+
+    def close(self):
+        raise telepot.exception.StopListening()
+
+
+def say_bye(conversation):
+    conversation.sender.sendMessage('bye')
+
+
+def start_sessions(conversation_factory):
+    """
+    Starts the session store both bots keep their conversations in, over a bounded worker pool.
+    """
+    variables = Variables()
+    try:
+        access_list.users()
+    except AccessConfigError as e:
+        # Not fatal, every message is answered with the error until the config is fixed
+        logging.error("Bad configuration: " + str(e))
+    worker_pool = WorkerPool(variables.get_int("workers", WORKERS), variables.get_int("worker_queue", MAX_PENDING))
+    sessions = SessionStore(conversation_factory, worker_pool,
+                            variables.get_int("session_idle_seconds", SESSION_IDLE_SECONDS), on_evict=say_bye)
+    sessions.start_sweeper()
+    return sessions
+
+
 def main():
-    configure_log()
+    configure_log("bot")
 
     bot_token = Variables()["telegram_token"]
+    start_snapshot_poller()
+    start_stats_exporters()
 
-    bot = telepot.DelegatorBot(bot_token, [
-        pave_event_space()(
-            per_chat_id(), create_open, HomeBot, timeout=15),
-    ])
-
-    bot.message_loop(run_forever='Listening ...')
+    bot = telepot.Bot(bot_token)
+    sessions = start_sessions(lambda chat_id: HomeBot(bot, chat_id))
+    bot.message_loop({'chat': sessions.dispatch}, run_forever='Listening ...')
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,203 @@
+import importlib
+import logging
+import time
+from collections import namedtuple
+from access import MEMBER, allows
+from instrumentation import instrumentation
+
+Arg = namedtuple('Arg', ['name', 'type', 'optional', 'rest'])
+
+
+def arg(name, type=str, optional=False, rest=False):
+    """
+    Describes a command argument. A rest argument takes all the remaining words.
+    """
+    return Arg(name, type, optional, rest)
+
+
+class CommandNode(object):
+    """
+    A command path segment. Groups have children, leaves have a handler class (or a lazy 'module:Class' name)
+    and the least role allowed to run them.
+    """
+    __slots__ = ('name', 'path', 'title', 'handler', 'args', 'usage', 'aliases', 'role', 'children', '_lookup')
+
+    def __init__(self, name, path, title=None, handler=None, args=(), usage=None, aliases=(), role=MEMBER):
+        self.name = name
+        self.path = path
+        self.title = title
+        self.handler = handler
+        self.args = tuple(args)
+        self.usage = usage
+        self.aliases = tuple(aliases)
+        self.role = role
+        self.children = {}
+        self._lookup = {}
+
+    @property
+    def is_group(self):
+        return self.handler is None
+
+    def handler_class(self):
+        if isinstance(self.handler, str):
+            module_name, class_name = self.handler.split(':')
+            self.handler = getattr(importlib.import_module(module_name), class_name)
+        return self.handler
+
+    def compile(self):
+        """
+        Builds the lookup of this node and its children: names and aliases, and every unambiguous prefix of them.
+        """
+        names = {}
+        for child in self.children.values():
+            for name in (child.name,) + child.aliases:
+                names[name] = child
+        prefixes = {}
+        for name, child in names.items():
+            for length in range(1, len(name)):
+                prefix = name[:length]
+                if prefix not in names:
+                    # Ambiguous prefixes map to None
+                    prefixes[prefix] = child if prefixes.get(prefix, child) is child else None
+        self._lookup = {prefix: child for prefix, child in prefixes.items() if child is not None}
+        self._lookup.update(names)
+        for child in self.children.values():
+            child.compile()
+
+    def child(self, word):
+        return self._lookup.get(word.lstrip('/').lower())
+
+    def usage_text(self):
+        if self.usage is not None:
+            return self.usage
+        parts = []
+        for argument in self.args:
+            name = argument.name + ("..." if argument.rest else "")
+            parts.append("[" + name + "]" if argument.optional else name)
+        return " ".join(parts)
+
+    def help_message(self):
+        commands = []
+        for child in self.children.values():
+            usage = child.usage_text()
+            commands.append("/" + child.name + (" " + usage if usage else ""))
+        return "{title} help - {commands}".format(title=self.title, commands=" ".join(commands))
+
+    def parse_args(self, words):
+        """
+        Returns an error message if words don't fit the argument schema, None otherwise.
+        """
+        remaining = list(words)
+        for argument in self.args:
+            if not remaining:
+                if argument.optional:
+                    continue
+                return "Missing " + argument.name
+            values = remaining if argument.rest else remaining[:1]
+            remaining = [] if argument.rest else remaining[1:]
+            try:
+                [argument.type(value) for value in values]
+            except ValueError:
+                return "Bad {name}: {value}".format(name=argument.name, value=" ".join(values))
+        if remaining:
+            return "Unexpected " + " ".join(remaining)
+        return None
+
+
+class CommandRouter(object):
+    """
+    Declarative table of nested commands, compiled into a trie that matches names, aliases and unique prefixes.
+    """
+    def __init__(self, title="Commands"):
+        self.root = CommandNode('', (), title=title)
+
+    def _node(self, path):
+        node = self.root
+        for name in path.split():
+            if name not in node.children:
+                node.children[name] = CommandNode(name, node.path + (name,))
+            node = node.children[name]
+        return node
+
+    def group(self, path, title, aliases=()):
+        node = self._node(path)
+        node.title = title
+        node.aliases = tuple(aliases)
+
+    def add(self, path, handler, args=(), usage=None, aliases=(), role=MEMBER):
+        node = self._node(path)
+        node.handler = handler
+        node.args = tuple(args)
+        node.usage = usage
+        node.aliases = tuple(aliases)
+        node.role = role
+
+    def compile(self):
+        self.root.compile()
+
+    def resolve(self, node, words):
+        """
+        Follows words down from node while they name commands, returns the node reached and the remaining words.
+        """
+        index = 0
+        while node.is_group and index < len(words):
+            child = node.child(words[index])
+            if child is None:
+                break
+            node = child
+            index += 1
+        return node, words[index:]
+
+    def dispatch(self, bot, node, text):
+        """
+        Runs text relative to node. Returns the handler that takes over the conversation, or None to stay put.
+        """
+        words = text.split()
+        target, remaining = self.resolve(node, words)
+        if target.is_group:
+            if remaining or target is node:
+                if node is self.root:
+                    bot.sender.sendMessage("Unknown command: " + text + "\n" + self.root.help_message())
+                    bot.close()
+                bot.sender.sendMessage(target.help_message())
+                return None
+            return CommandGroupHandler(bot, self, target)
+
+        name = " ".join(target.path)
+        if not allows(bot.role, target.role):
+            logging.warning("refused command {name} to a {role}".format(name=name, role=bot.role), extra={
+                'event': 'refused', 'command': name, 'chat': bot.chat_id, 'user': bot.user, 'role': bot.role})
+            bot.sender.sendMessage("Not allowed: /{path} needs the {role} role".format(
+                path=" /".join(target.path), role=target.role))
+            return None
+        error = target.parse_args(remaining)
+        if error:
+            bot.sender.sendMessage("{error}\nUsage: /{path} {usage}".format(
+                error=error, path=" /".join(target.path), usage=target.usage_text()))
+            return None
+        started_at = time.perf_counter()
+        try:
+            with instrumentation.span("command", name):
+                return target.handler_class()(bot, " ".join(remaining))
+        finally:
+            logging.info("handled command " + name, extra={
+                'event': 'command', 'command': name, 'chat': bot.chat_id, 'user': bot.user, 'role': bot.role,
+                'latency_ms': round((time.perf_counter() - started_at) * 1000, 3)})
+
+
+class CommandGroupHandler(object):
+    """
+    Waits for a sub-command of a group, then hands the rest of the conversation to it.
+    """
+    def __init__(self, bot, router, node):
+        self.bot = bot
+        self.router = router
+        self.node = node
+        self.command_handler = None
+        self.bot.sender.sendMessage(node.help_message())
+
+    def handle_command(self, text):
+        if self.command_handler:
+            self.command_handler.handle_command(text)
+            return
+        self.command_handler = self.router.dispatch(self.bot, self.node, text)
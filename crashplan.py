@@ -1,15 +1,26 @@
 import requests
-from pathlib import Path
 import json
 import arrow
-import math
-from pprint import pprint
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import instrumentation
+from workers import backend_limits
 
 class Crashplan(object):
     """
     Provides access to Crashplan consumer information.
     """
     BASE_API_URL = "https://account.crashplan.com/api/"
+    TIMEOUT_SECONDS = 15
+    CACHE_TTL_SECONDS = 60
+
+    CachedResponse = namedtuple('CachedResponse', ['fetched_at', 'etag', 'last_modified', 'data'])
+
+    _clients = {}
+    _clients_lock = threading.Lock()
+    _executor = ThreadPoolExecutor(max_workers=2)
 
     class SubscriptionInfo(object):
         def __init__(self, subscription_dict):
@@ -31,14 +42,57 @@ class Crashplan(object):
 
     def __init__(self, username, password):
         self.auth = (username, password)
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self._account_id = None
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, username, password):
+        """
+        Returns a client kept for the process lifetime, so its connections, account id and cache are reused.
+        """
+        with cls._clients_lock:
+            key = (username, password)
+            if key not in cls._clients:
+                cls._clients[key] = cls(username, password)
+            return cls._clients[key]
 
     def fetch_url_json(self, url):
-        return json.loads(requests.get(url, auth=self.auth).text)
+        with self._lock:
+            cached = self._cache.get(url)
+        if cached and time.monotonic() - cached.fetched_at < self.CACHE_TTL_SECONDS:
+            return cached.data
+
+        headers = {}
+        if cached and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached and cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+        with backend_limits.slot("crashplan"), instrumentation.span("backend", "crashplan"):
+            response = self.session.get(url, headers=headers, timeout=self.TIMEOUT_SECONDS)
+        if response.status_code == 304 and cached:
+            data = cached.data
+            # A 304 doesn't have to repeat the validators
+            etag = response.headers.get("ETag", cached.etag)
+            last_modified = response.headers.get("Last-Modified", cached.last_modified)
+        else:
+            response.raise_for_status()
+            data = json.loads(response.text)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+
+        with self._lock:
+            self._cache[url] = self.CachedResponse(time.monotonic(), etag, last_modified, data)
+        return data
 
     def get_account_id(self):
-        MY_ACCOUNT_URL = self.BASE_API_URL + "Account/my"
-        data = self.fetch_url_json(MY_ACCOUNT_URL)
-        return data["data"]["accountId"]
+        if self._account_id is None:
+            MY_ACCOUNT_URL = self.BASE_API_URL + "Account/my"
+            data = self.fetch_url_json(MY_ACCOUNT_URL)
+            self._account_id = data["data"]["accountId"]
+        return self._account_id
 
     def get_subscription(self):
         SUBSCRIPTION_URL = self.BASE_API_URL + "Subscription?accountId=" + str(self.get_account_id())
@@ -58,3 +112,11 @@ class Crashplan(object):
         data = self.fetch_url_json(COMPUTERS_URL)
         computers = data["data"]["computers"]
         return list(map(lambda c: self.ComputerInfo(c), filter(lambda c: c["backupUsage"], computers)))
+
+    def get_subscription_and_computers(self):
+        """
+        Fetches the subscription and the computers concurrently.
+        """
+        subscription = self._executor.submit(self.get_subscription)
+        computers = self._executor.submit(self.computers)
+        return subscription.result(), computers.result()
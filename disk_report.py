@@ -0,0 +1,108 @@
+import logging
+import re
+import select
+import threading
+from concurrent.futures import Future, wait
+from instrumentation import instrumentation
+from lazy_modules import psutil
+
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+
+class DiskReport(object):
+    """
+    Disk usage of the mount points matching a pattern.
+    The filtered mount list is cached until the kernel reports a mount table change, and each mount is
+    queried on its own thread so a hung network mount is reported as unresponsive instead of blocking.
+    """
+    TIMEOUT_SECONDS = 3
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mountpoints = None
+        self._pattern = None
+        self._pending = {}
+        self._mountinfo = None
+        self._poller = None
+        self._watch_mountinfo()
+
+    def _watch_mountinfo(self):
+        try:
+            self._mountinfo = open(MOUNTINFO_PATH, 'rb')
+            self._mountinfo.read()
+            self._poller = select.poll()
+            self._poller.register(self._mountinfo, select.POLLPRI | select.POLLERR)
+        except (OSError, AttributeError):
+            # Without mountinfo (or poll) the mount list is read on every report
+            logging.info("Mount table changes can't be watched, disk mounts won't be cached")
+            self._mountinfo = None
+            self._poller = None
+
+    def _mount_table_changed(self):
+        if self._poller is None:
+            return True
+        if not self._poller.poll(0):
+            return False
+        # The change stays signaled until the table is read again
+        self._mountinfo.seek(0)
+        self._mountinfo.read()
+        return True
+
+    def mountpoints(self, pattern):
+        with self._lock:
+            changed = self._mount_table_changed()
+            if changed or self._mountpoints is None or pattern != self._pattern:
+                regex = re.compile(pattern)
+                self._mountpoints = [p.mountpoint for p in psutil.disk_partitions(True)
+                                     if regex.fullmatch(p.mountpoint)]
+                self._pattern = pattern
+            return list(self._mountpoints)
+
+    def usages(self, pattern):
+        """
+        Returns (mount point, usage, error) for every matching mount, usage is None when error is set.
+        """
+        futures = []
+        new_futures = []
+        for mountpoint in self.mountpoints(pattern):
+            future, is_new = self._usage_future(mountpoint)
+            futures.append((mountpoint, future))
+            if is_new:
+                new_futures.append(future)
+        # Mounts already stuck since an earlier report aren't waited for again
+        with instrumentation.span("backend", "disk"):
+            wait(new_futures, timeout=self.TIMEOUT_SECONDS)
+
+        usages = []
+        for mountpoint, future in futures:
+            if not future.done():
+                usages.append((mountpoint, None, "unresponsive"))
+            elif future.exception() is not None:
+                usages.append((mountpoint, None, str(future.exception())))
+            else:
+                usages.append((mountpoint, future.result(), None))
+        return usages
+
+    def _usage_future(self, mountpoint):
+        # A mount still stuck from an earlier report keeps its single thread instead of piling up more
+        with self._lock:
+            future = self._pending.get(mountpoint)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._pending[mountpoint] = future
+
+        def run():
+            try:
+                future.set_result(psutil.disk_usage(mountpoint))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._pending.pop(mountpoint, None)
+
+        threading.Thread(target=run, name="statvfs " + mountpoint, daemon=True).start()
+        return future, True
+
+
+disk_report = DiskReport()
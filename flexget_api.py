@@ -0,0 +1,103 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flexget_status import TaskStatus, parse_time
+from instrumentation import instrumentation
+from lazy_modules import requests
+from workers import backend_limits
+
+
+class FlexgetAPIError(Exception):
+    pass
+
+
+class FlexgetUnavailableError(FlexgetAPIError):
+    """
+    The daemon couldn't be reached at all, callers may fall back to the CLI.
+    """
+    pass
+
+
+class FlexgetAPI(object):
+    """
+    Talks to a running Flexget daemon through its web API (flexget daemon start with the web_server plugin).
+    """
+    LOOKUP_WORKERS = 4
+
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+    # (base_url, task id) -> (last execution, last success)
+    _last_successes = {}
+    _last_successes_lock = threading.Lock()
+    _executor = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS)
+
+    def __init__(self, base_url, token=None, timeout=10, backend="flexget"):
+        self.base_url = base_url.rstrip('/') + '/api/'
+        self.timeout = timeout
+        # The backend_limits slot, remote nodes have their own
+        self.backend = backend
+        self.session = self._session(self.base_url, token)
+
+    @classmethod
+    def _session(cls, base_url, token):
+        with cls._sessions_lock:
+            if base_url not in cls._sessions:
+                session = requests.Session()
+                if token:
+                    session.headers['Authorization'] = 'Token ' + token
+                cls._sessions[base_url] = session
+            return cls._sessions[base_url]
+
+    def _request(self, method, path, **kwargs):
+        try:
+            with backend_limits.slot(self.backend), instrumentation.span("backend", "flexget." + path.split('/')[0]):
+                response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise FlexgetUnavailableError(str(e))
+        if response.status_code >= 400:
+            try:
+                message = response.json().get('message', response.reason)
+            except ValueError:
+                message = response.reason
+            raise FlexgetAPIError(message)
+        return response.json()
+
+    def status(self):
+        runs = []
+        for task in self._request('GET', 'status/'):
+            last_execution = task.get('last_execution') or {}
+            runs.append((task, parse_time(last_execution.get('start')), bool(last_execution.get('succeeded'))))
+
+        # After a failed run the last success takes a lookup of its own. It can only change with a new run, so it's
+        # kept per task along with the run it was looked up for, and the lookups still missing are made concurrently
+        missing = []
+        with self._last_successes_lock:
+            for task, last_exec, succeeded in runs:
+                cached = self._last_successes.get((self.base_url, task['id']))
+                if not succeeded and (cached is None or cached[0] != last_exec):
+                    missing.append((task['id'], last_exec))
+        lookups = self._executor.map(lambda lookup: self._last_success(lookup[0]), missing)
+        for (task_id, last_exec), last_success in zip(missing, lookups):
+            with self._last_successes_lock:
+                self._last_successes[(self.base_url, task_id)] = (last_exec, last_success)
+
+        statuses = []
+        for task, last_exec, succeeded in runs:
+            if succeeded:
+                last_success = last_exec
+            else:
+                with self._last_successes_lock:
+                    last_success = self._last_successes[(self.base_url, task['id'])][1]
+            statuses.append(TaskStatus(task['name'], last_exec, last_success))
+        return statuses
+
+    def _last_success(self, task_id):
+        executions = self._request('GET', 'status/{id}/executions/'.format(id=task_id),
+                                   params={'succeeded': 'true', 'page': 1, 'per_page': 1,
+                                           'sort_by': 'start', 'order': 'desc'})
+        if not executions:
+            return None
+        return parse_time(executions[0].get('start'))
+
+    def execute(self, task_name):
+        result = self._request('POST', 'tasks/execute/', json={'tasks': [task_name]})
+        return [task['name'] for task in result.get('tasks', [])]
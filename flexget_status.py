@@ -0,0 +1,99 @@
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+TaskStatus = namedtuple('TaskStatus', ['name', 'last_execution', 'last_success'])
+
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+NEVER = "-"
+
+# Header names used by different Flexget versions for each TaskStatus field
+HEADER_ALIASES = {
+    'name': ('task', 'name'),
+    'last_execution': ('last execution', 'last run', 'last_execution'),
+    'last_success': ('last success', 'last_success'),
+}
+
+
+class FlexgetStatusError(ValueError):
+    """
+    The status output has no header this parser recognizes.
+    """
+    pass
+
+
+_memo_lock = threading.Lock()
+_memo_digest = None
+_memo_statuses = None
+
+
+def parse_time(value):
+    if not value or value == NEVER:
+        return None
+    try:
+        return datetime.strptime(value.replace('T', ' ')[:len("YYYY-MM-DD HH:MM")], TIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def parse_status_table(output):
+    """
+    Parses 'flexget status --porcelain' output into TaskStatus records, raises FlexgetStatusError when the header
+    isn't recognized. Identical output is parsed only once, the last result is kept keyed by its hash.
+    """
+    global _memo_digest, _memo_statuses
+    digest = hashlib.sha1(output.encode('utf-8')).digest()
+    with _memo_lock:
+        if digest == _memo_digest:
+            return _memo_statuses
+
+    statuses = list(iter_status_table(output.splitlines()))
+    with _memo_lock:
+        _memo_digest = digest
+        _memo_statuses = statuses
+    return statuses
+
+
+def iter_status_table(lines):
+    columns = None
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = [field.strip() for field in line.split('|')]
+        if columns is None:
+            columns = _columns_from_header(fields)
+            if columns is None:
+                raise FlexgetStatusError("Unrecognized flexget status header: " + line.strip())
+            header_length = len(fields)
+            continue
+
+        if set(line.strip()) <= set('-+| '):
+            continue
+        if len(fields) < header_length:
+            logging.warning("Skipping malformed flexget status row: " + line)
+            continue
+
+        # Task names may contain '|', the surplus fields all belong to the name column
+        extra = len(fields) - header_length
+        name_index = columns['name']
+        name = '|'.join(line.split('|')[name_index:name_index + extra + 1]).strip()
+        values = {'name': name}
+        for field, index in columns.items():
+            if field != 'name':
+                values[field] = parse_time(fields[index + extra if index > name_index else index])
+        yield TaskStatus(**values)
+
+
+def _columns_from_header(fields):
+    lowered = [field.lower() for field in fields]
+    columns = {}
+    for field, aliases in HEADER_ALIASES.items():
+        for alias in aliases:
+            if alias in lowered:
+                columns[field] = lowered.index(alias)
+                break
+        else:
+            return None
+    return columns
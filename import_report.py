@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+"""
+Reports what a module costs to import, using python -X importtime.
+
+    import_report.py [MODULE] [--top N] [--budget MS]
+
+MODULE defaults to bot. With --budget the exit status is 1 when importing MODULE takes longer than MS milliseconds,
+so it can guard startup time from a deploy script or cron.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from collections import namedtuple
+
+ImportTime = namedtuple('ImportTime', ['module', 'self_us', 'cumulative_us', 'depth'])
+TIMEOUT_SECONDS = 120
+
+
+def import_times(module='bot'):
+    """
+    Imports module in a fresh interpreter and returns an ImportTime for every module it loaded.
+    """
+    if not all(part.isidentifier() for part in module.split('.')):
+        raise ValueError("Not a module name: " + module)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=directory,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                                 timeout=TIMEOUT_SECONDS)
+    except subprocess.TimeoutExpired:
+        raise ImportError("Importing {module} timed out".format(module=module))
+    times = []
+    for line in process.stderr.splitlines():
+        # import time:   self [us] | cumulative | imported package
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append(ImportTime(name.strip(), int(parts[0]), int(parts[1]), depth))
+    if process.returncode != 0:
+        error = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "exit status {code}".format(
+            code=process.returncode)
+        raise ImportError("Importing {module} failed: {error}".format(module=module, error=error))
+    return times
+
+
+def total_ms(times, module='bot'):
+    return next((t.cumulative_us for t in times if t.module == module and t.depth == 0), 0) / 1000.0
+
+
+def report(module='bot', top=15, times=None):
+    """
+    Returns report lines: the total import time of module and its slowest direct and indirect imports.
+    """
+    times = times if times is not None else import_times(module)
+    lines = ["{module}: {total:.1f}ms to import, {count} modules".format(module=module, count=len(times),
+                                                                         total=total_ms(times, module))]
+    slowest = sorted((t for t in times if t.module != module), key=lambda t: t.cumulative_us, reverse=True)
+    for t in slowest[:top]:
+        lines.append("{cumulative:8.1f}ms {self_time:8.1f}ms  {module}".format(
+            cumulative=t.cumulative_us / 1000.0, self_time=t.self_us / 1000.0, module=t.module))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports what a module costs to import")
+    parser.add_argument('module', nargs='?', default='bot')
+    parser.add_argument('--top', type=int, default=15, help="number of slowest imports to list")
+    parser.add_argument('--budget', type=float, help="fail when the import takes longer, in milliseconds")
+    args = parser.parse_args()
+
+    try:
+        times = import_times(args.module)
+    except (ImportError, ValueError) as e:
+        print(e)
+        sys.exit(2)
+    print("\n".join(report(args.module, args.top, times)))
+    if args.budget is not None and total_ms(times, args.module) > args.budget:
+        print("Over the {budget:.0f}ms budget".format(budget=args.budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKET_COUNT = SUB_BUCKET_COUNT >> 1
+PERCENTILES = (50, 95, 99)
+
+logger = logging.getLogger('instrumentation')
+
+
+def _bucket_index(value):
+    # Values below SUB_BUCKET_COUNT get a bucket each, above that every power of two is split into
+    # HALF_SUB_BUCKET_COUNT buckets, so buckets are never wider than about 6% of their values
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+
+def _bucket_range(index):
+    if index < SUB_BUCKET_COUNT:
+        return index, index
+    shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+    low = (index - (shift << (SUB_BUCKET_BITS - 1))) << shift
+    return low, low + (1 << shift) - 1
+
+
+class LatencyHistogram(object):
+    """
+    HDR-style histogram of durations in microseconds: log-linear buckets, constant memory per order of magnitude.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = max(0, int(seconds * 1000000))
+        index = _bucket_index(micros)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """
+        Returns the duration in seconds below which percent of the recordings fall, None when empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                low, high = _bucket_range(index)
+                return min((low + high) / 2.0 / 1000000, self.max)
+        return self.max
+
+    def copy(self):
+        histogram = LatencyHistogram()
+        histogram.counts = dict(self.counts)
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.max = self.max
+        return histogram
+
+
+class Instrumentation(object):
+    """
+    Latency histograms keyed by kind (command, backend, format, telegram) and name.
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def record(self, kind, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get((kind, name))
+            if histogram is None:
+                histogram = self._histograms[(kind, name)] = LatencyHistogram()
+            histogram.record(seconds)
+
+    @contextmanager
+    def span(self, kind, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started_at
+            self.record(kind, name, seconds)
+            if kind == 'backend':
+                # Sampled by the log pipeline, backends are called many times per command
+                logger.info("backend call " + name, extra={'event': 'backend', 'backend': name,
+                                                           'latency_ms': round(seconds * 1000, 3)})
+
+    def timed(self, kind, name):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(kind, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def histograms(self):
+        """
+        Returns ((kind, name), histogram) pairs sorted by kind and name, copied so they can be read without locking.
+        """
+        with self._lock:
+            return sorted((key, histogram.copy()) for key, histogram in self._histograms.items())
+
+    def summary(self):
+        return [dict(kind=kind, name=name, count=histogram.count, max=histogram.max,
+                     **{'p{percent}'.format(percent=percent): histogram.percentile(percent)
+                        for percent in PERCENTILES})
+                for (kind, name), histogram in self.histograms()]
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self.started_at = time.time()
+
+    def prometheus_text(self):
+        lines = ["# TYPE homebot_latency_seconds summary"]
+        for (kind, name), histogram in self.histograms():
+            labels = 'kind="{kind}",name="{name}"'.format(kind=_escape_label(kind), name=_escape_label(name))
+            for percent in PERCENTILES:
+                lines.append('homebot_latency_seconds{{{labels},quantile="{quantile}"}} {value:.6f}'.format(
+                    labels=labels, quantile=percent / 100.0, value=histogram.percentile(percent)))
+            lines.append('homebot_latency_seconds_sum{{{labels}}} {value:.6f}'.format(
+                labels=labels, value=histogram.total))
+            lines.append('homebot_latency_seconds_count{{{labels}}} {value}'.format(
+                labels=labels, value=histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def start_prometheus_exporter(port, address='127.0.0.1', source=None):
+    """
+    Serves the histograms in Prometheus text format on http://address:port/metrics from a daemon thread.
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    source = source or instrumentation
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = source.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((address, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="prometheus-exporter", daemon=True).start()
+    return server
+
+
+def start_json_log(interval, source=None):
+    """
+    Logs the summary, in the stats field of a 'stats' logger record, every interval seconds from a daemon thread.
+    """
+    source = source or instrumentation
+    stats_logger = logging.getLogger('stats')
+
+    def run():
+        while True:
+            time.sleep(interval)
+            stats_logger.info("stats", extra={'event': 'stats',
+                                              'stats': {'time': time.time(), 'latency': source.summary()}})
+
+    thread = threading.Thread(target=run, name="stats-log", daemon=True)
+    thread.start()
+    return thread
+
+
+instrumentation = Instrumentation()
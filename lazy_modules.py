@@ -0,0 +1,26 @@
+"""
+Third-party modules that are slow to import, loaded the first time one of their attributes is used.
+Importing them here instead of at the top of a module keeps the bot's startup fast, see import_report.py.
+"""
+
+import importlib
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        # Only called for attributes LazyModule doesn't have itself, i.e. the module's
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return "<lazy module '{name}'>".format(name=self._name)
+
+
+psutil = LazyModule('psutil')
+requests = LazyModule('requests')
+transmissionrpc = LazyModule('transmissionrpc')
@@ -0,0 +1,175 @@
+"""
+Logging shared by the bot and the reporters: JSON lines written by a background thread, with compressed rotation.
+
+Callers only put records on a queue, formatting and disk writes happen on the listener thread.
+Structured fields are passed as extra, e.g. logging.info("...", extra={'event': 'command', 'command': name}).
+Records of a high-volume event are sampled, 1 in log_sample_EVENT is kept (warnings and errors always are).
+"""
+
+import atexit
+import copy
+import gzip
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+from datetime import datetime
+from variables import Variables, join_path_to_script_directory
+
+MAX_BYTES = 1024 * 1024
+BACKUP_COUNT = 5
+STRUCTURED_FIELDS = ('event', 'command', 'chat', 'user', 'role', 'backend', 'node', 'latency_ms', 'sampled', 'stats')
+# Keep 1 in N records of these events unless log_sample_EVENT says otherwise
+SAMPLE_EVERY = {'backend': 10}
+
+_listener = None
+_queue_handler = None
+_listener_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps 1 in N records of each sampled event and marks the kept ones with sampled=N.
+    """
+    def __init__(self, every):
+        super(SamplingFilter, self).__init__()
+        self.every = every
+        self._counters = {event: itertools.count() for event in every}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        every = self.every.get(event)
+        if not every or every == 1 or record.levelno >= logging.WARNING:
+            return True
+        # itertools.count is advanced atomically, no lock needed
+        if next(self._counters[event]) % every:
+            return False
+        record.sampled = every
+        return True
+
+
+class PreparedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Renders the message and the exception on the caller's thread, so the record that's queued is self-contained,
+    and leaves the rest of the formatting to the listener.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _compress(source, destination):
+    with open(source, 'rb') as f_in, gzip.open(destination, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def compressed_rotating_handler(path, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+    """
+    A RotatingFileHandler whose rotated files are gzipped, e.g. bot.log.1.gz.
+    """
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.namer = lambda name: name + '.gz'
+    handler.rotator = _compress
+    return handler
+
+
+def _positive_int(key, value, default, problems):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = 0
+    if number < 1:
+        problems.append("Bad {key} in variables.cfg: {value}, using {default}".format(
+                        key=key, value=value, default=default))
+        return default
+    return number
+
+
+def _log_level(value, problems):
+    level = (value or "").strip().upper() or "INFO"
+    # getLevelName maps known level names to their numbers and anything else to a string
+    if not isinstance(logging.getLevelName(level), int):
+        problems.append("Bad log_level in variables.cfg: {value}, using INFO".format(value=value))
+        return logging.INFO
+    return level
+
+
+def configure_log(name):
+    """
+    Sends the root logger's records to logs/NAME.log through a background listener, stopped (and flushed) at exit.
+    Configured from variables.cfg: log_level, log_max_bytes, log_backups and log_sample_EVENT. Bad values are logged
+    and replaced by the defaults, so a typo there can't keep a script from starting.
+    """
+    global _listener, _queue_handler
+    with _listener_lock:
+        if _listener is not None:
+            return _listener
+
+        variables = Variables()
+        problems = []
+        every = dict(SAMPLE_EVERY)
+        for key, value in variables.config.items():
+            if key.startswith("log_sample_") and value.strip():
+                event = key[len("log_sample_"):]
+                every[event] = _positive_int(key, value, every.get(event, 1), problems)
+        max_bytes = _positive_int("log_max_bytes", variables.get("log_max_bytes") or MAX_BYTES, MAX_BYTES, problems)
+        backups = _positive_int("log_backups", variables.get("log_backups") or BACKUP_COUNT, BACKUP_COUNT, problems)
+
+        file_handler = compressed_rotating_handler(
+            join_path_to_script_directory(os.path.join('logs', name + '.log')), max_bytes, backups)
+        file_handler.setFormatter(JsonFormatter())
+
+        _queue_handler = PreparedQueueHandler(queue.SimpleQueue())
+        _queue_handler.addFilter(SamplingFilter(every))
+        root = logging.getLogger()
+        root.setLevel(_log_level(variables.get("log_level"), problems))
+        root.addHandler(_queue_handler)
+
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, file_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_log)
+        for problem in problems:
+            logging.warning(problem)
+        return _listener
+
+
+def stop_log():
+    """
+    Detaches the queue from the root logger, writes out the queued records and stops the listener.
+    """
+    global _listener, _queue_handler
+    with _listener_lock:
+        if _listener is not None:
+            logging.getLogger().removeHandler(_queue_handler)
+            _listener.stop()
+            _listener = _queue_handler = None
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+import telepot.exception
+from instrumentation import instrumentation
+from rendering import PARSE_MODE, escape
+
+MAX_MESSAGE_LENGTH = 4096
+MESSAGES_PER_PAGE = 5
+
+
+def pack_messages(items, separator='\n\n', limit=MAX_MESSAGE_LENGTH):
+    """
+    Joins items into as few messages as possible, never splitting an item unless it alone exceeds the limit.
+    Yields each message once it's full, so items can be a generator rendered only as far as the messages are used.
+    """
+    current = []
+    current_length = 0
+    for item in items:
+        for part in _split_text(item, limit):
+            added_length = len(part) + (len(separator) if current else 0)
+            if current and current_length + added_length > limit:
+                yield separator.join(current)
+                current = []
+                current_length = 0
+                added_length = len(part)
+            current.append(part)
+            current_length += added_length
+    if current:
+        yield separator.join(current)
+
+
+def _split_text(text, limit):
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+            # Don't separate an escaping backslash from the character it escapes
+            if (cut - len(text[:cut].rstrip('\\'))) % 2:
+                cut -= 1
+        yield text[:cut]
+        text = text[cut:].lstrip('\n')
+    yield text
+
+
+def page_of(messages, page, messages_per_page=MESSAGES_PER_PAGE):
+    """
+    Returns (messages of the page, page, pages). messages is consumed up to one message past the page, pages is None
+    when there is such a message, since counting the pages would take packing them all. Past the end is the last page.
+    """
+    page = max(page, 1)
+    current = []
+    current_page = 1
+    for message in messages:
+        if len(current) == messages_per_page:
+            if current_page == page:
+                return current, page, None
+            current = []
+            current_page += 1
+        current.append(message)
+    return current, current_page, current_page
+
+
+def send_paged(sender, items, page=1, next_page_command=None, parse_mode='Markdown'):
+    """
+    Sends a page of items packed into messages. Items can be a generator, only the rows up to the page are rendered.
+    """
+    messages, page, pages = page_of(pack_messages(items), page or 1)
+    if pages != 1:
+        if pages is None:
+            footer = "Page {page}".format(page=page)
+            if next_page_command:
+                footer += " - {command} {next} for more".format(command=next_page_command, next=page + 1)
+        else:
+            footer = "Page {page}/{pages}".format(page=page, pages=pages)
+        if parse_mode == PARSE_MODE:
+            footer = escape(footer)
+        if len(messages[-1]) + len(footer) + 2 <= MAX_MESSAGE_LENGTH:
+            messages[-1] += "\n\n" + footer
+        else:
+            messages.append(footer)
+    for message in messages:
+        sender.sendMessage(message, parse_mode=parse_mode)
+
+
+class TokenBucket(object):
+    """
+    Allows bursts of up to capacity calls and rate calls per second on average.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def consume(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                time.sleep(self._blocked_until - now)
+                now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens < 1:
+                time.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 1
+                self._updated_at = time.monotonic()
+            self._tokens -= 1
+
+    def block(self, seconds):
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+# Telegram allows about one message per second in a single chat, with short bursts
+CHAT_MESSAGES_PER_SECOND = 1
+CHAT_BURST = 3
+_chat_buckets = {}
+_chat_buckets_lock = threading.Lock()
+
+
+def chat_bucket(chat_id):
+    with _chat_buckets_lock:
+        if chat_id not in _chat_buckets:
+            _chat_buckets[chat_id] = TokenBucket(CHAT_MESSAGES_PER_SECOND, CHAT_BURST)
+        return _chat_buckets[chat_id]
+
+
+class ThrottledSender(object):
+    """
+    Wraps a telepot Sender (or Editor), pacing calls through a token bucket
+    and retrying after Telegram's retry_after.
+    """
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, sender, bucket):
+        self.sender = sender
+        self.bucket = bucket
+
+    def sendMessage(self, *args, **kwargs):
+        return self._send('sendMessage', *args, **kwargs)
+
+    def sendDocument(self, *args, **kwargs):
+        return self._send('sendDocument', *args, **kwargs)
+
+    def editMessageText(self, *args, **kwargs):
+        return self._send('editMessageText', *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.sender, name)
+
+    def _send(self, name, *args, **kwargs):
+        method = getattr(self.sender, name)
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            self.bucket.consume()
+            try:
+                with instrumentation.span("telegram", name):
+                    return method(*args, **kwargs)
+            except telepot.exception.TelegramError as e:
+                if e.error_code != 429 or attempt == self.MAX_ATTEMPTS:
+                    raise
+                retry_after = e.json.get('parameters', {}).get('retry_after', 1)
+                logging.warning("Telegram rate limit hit, retrying in {seconds}s".format(seconds=retry_after))
+                self.bucket.block(retry_after)
@@ -0,0 +1,170 @@
+import fcntl
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from urllib.parse import quote, unquote
+
+# Raw samples: timestamp, value
+RAW_RECORD = struct.Struct('<dd')
+# Rollup buckets: bucket start, count, sum, min, max
+ROLLUP_RECORD = struct.Struct('<ddddd')
+RAW = 'raw'
+ROLLUPS = (('1m', 60), ('1h', 60 * 60), ('1d', 24 * 60 * 60))
+# Longest span each rollup is used for, before moving to the next coarser one
+ROLLUP_MAX_SPANS = {'1m': 6 * 60 * 60, '1h': 31 * 24 * 60 * 60}
+PERIOD_UNITS = {'m': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+# Written by speedtestReporter.py, read by the bot's /speedtest history
+SPEEDTEST_PING_SERIES = "speedtest.ping"
+SPEEDTEST_DOWNLOAD_SERIES = "speedtest.download"
+SPEEDTEST_UPLOAD_SERIES = "speedtest.upload"
+
+
+class Bucket(namedtuple('Bucket', ['start', 'count', 'total', 'min', 'max'])):
+    __slots__ = ()
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+
+def parse_period(text, default=None):
+    """
+    Parses periods like '30m', '12h', '7d' or '2w' into seconds.
+    """
+    text = (text or '').strip().lower()
+    if len(text) < 2 or text[-1] not in PERIOD_UNITS or not text[:-1].isdigit():
+        return default
+    return int(text[:-1]) * PERIOD_UNITS[text[-1]]
+
+
+def downsample(buckets, points):
+    """
+    Merges consecutive buckets so that at most the given number of points remain.
+    """
+    if len(buckets) <= points:
+        return buckets
+    size = -(-len(buckets) // points)
+    merged = []
+    for index in range(0, len(buckets), size):
+        group = buckets[index:index + size]
+        merged.append(Bucket(group[0].start, sum(b.count for b in group), sum(b.total for b in group),
+                             min(b.min for b in group), max(b.max for b in group)))
+    return merged
+
+
+class MetricsStore(object):
+    """
+    Local append-only time series store.
+    Every series keeps its raw samples and 1m/1h/1d rollups in fixed width record files, so queries
+    binary search a memory map of the rollup that fits the requested span.
+    Several processes may write to the same store, files are locked while they are updated.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, series, resolution):
+        file_name = "{series}.{resolution}".format(series=quote(series, safe=''), resolution=resolution)
+        return os.path.join(self.directory, file_name)
+
+    def series(self, prefix=''):
+        suffix = '.' + RAW
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        series = [unquote(name[:-len(suffix)]) for name in names if name.endswith(suffix)]
+        return sorted(s for s in series if s.startswith(prefix))
+
+    def record(self, series, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        os.makedirs(self.directory, exist_ok=True)
+        with self._open_locked(self._path(series, RAW)) as f:
+            f.seek(self._aligned_size(f, RAW_RECORD))
+            f.write(RAW_RECORD.pack(timestamp, value))
+        for resolution, seconds in ROLLUPS:
+            self._add_to_rollup(self._path(series, resolution), timestamp - timestamp % seconds, value)
+
+    def _open_locked(self, path):
+        f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _aligned_size(self, f, record):
+        # A partial record left by a crash is overwritten by the next one
+        size = f.seek(0, os.SEEK_END)
+        return size - size % record.size
+
+    def _add_to_rollup(self, path, bucket_start, value):
+        with self._open_locked(path) as f:
+            size = self._aligned_size(f, ROLLUP_RECORD)
+            if size:
+                f.seek(size - ROLLUP_RECORD.size)
+                last = Bucket(*ROLLUP_RECORD.unpack(f.read(ROLLUP_RECORD.size)))
+                if last.start == bucket_start:
+                    f.seek(size - ROLLUP_RECORD.size)
+                    f.write(ROLLUP_RECORD.pack(last.start, last.count + 1, last.total + value,
+                                               min(last.min, value), max(last.max, value)))
+                    return
+                if last.start > bucket_start:
+                    # Late samples stay in the raw file only, rollups must stay sorted
+                    return
+            f.seek(size)
+            f.write(ROLLUP_RECORD.pack(bucket_start, 1, value, value, value))
+
+    def resolution_for(self, span):
+        for resolution, seconds in ROLLUPS:
+            if span <= ROLLUP_MAX_SPANS.get(resolution, span):
+                return resolution
+        return ROLLUPS[-1][0]
+
+    def query(self, series, start, end=None, resolution=None):
+        """
+        Returns the rollup buckets of series that start in [start, end).
+        """
+        end = time.time() if end is None else end
+        resolution = resolution or self.resolution_for(end - start)
+        try:
+            f = open(self._path(series, resolution), 'rb')
+        except FileNotFoundError:
+            return []
+        with f:
+            count = self._aligned_size(f, ROLLUP_RECORD) // ROLLUP_RECORD.size
+            if not count:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                index = self._first_index_at(m, count, start)
+                buckets = []
+                while index < count:
+                    bucket = Bucket(*ROLLUP_RECORD.unpack_from(m, index * ROLLUP_RECORD.size))
+                    if bucket.start >= end:
+                        break
+                    buckets.append(bucket)
+                    index += 1
+                return buckets
+
+    def _first_index_at(self, m, count, timestamp):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if ROLLUP_RECORD.unpack_from(m, middle * ROLLUP_RECORD.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def latest(self, series):
+        try:
+            f = open(self._path(series, RAW), 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            size = self._aligned_size(f, RAW_RECORD)
+            if not size:
+                return None
+            f.seek(size - RAW_RECORD.size)
+            return RAW_RECORD.unpack(f.read(RAW_RECORD.size))
+
+
+metrics_store = MetricsStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics'))
@@ -0,0 +1,174 @@
+import re
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from variables import Variables
+
+LOCAL_NODE_NAME = "local"
+NODE_TIMEOUT_SECONDS = 5
+FAN_OUT_WORKERS = 8
+# Calls to one node still running, past these its results are reported as busy instead of queueing more
+MAX_NODE_PENDING = 2
+RE_NODE_NAME = re.compile(r"^[A-Za-z][\w-]*$")
+# Node names can't be selection fields, so 'status:stopped' never reads as a torrent key
+RESERVED_NODE_NAMES = ('id', 'name', 'node', 'progress', 'ratio', 'status')
+
+NodeResult = namedtuple('NodeResult', ['node', 'value', 'error'])
+
+
+class NodeConfigError(Exception):
+    """
+    variables.cfg describes the nodes wrongly, nothing that needs the nodes can run until it's fixed.
+    """
+    pass
+
+
+class Node(object):
+    """
+    A machine running Transmission and Flexget. The local node uses the default Transmission pool and can fall back
+    to the flexget CLI, remote nodes are reached through Transmission RPC and the Flexget API only.
+    tag is the node name when there are several nodes and None otherwise, so single-node replies don't change.
+    """
+    def __init__(self, name, local, tag, address='localhost', port=9091, user=None, password=None,
+                 flexget_api_url=None, flexget_api_token=None, timeout=NODE_TIMEOUT_SECONDS):
+        self.name = name
+        self.local = local
+        self.tag = tag
+        self.address = address
+        self.port = port
+        self.user = user
+        self.password = password
+        self.flexget_api_url = flexget_api_url
+        self.flexget_api_token = flexget_api_token
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def transmission_pool(self):
+        from transmission_client import TransmissionClientPool, shared_pool
+
+        if self.local:
+            return shared_pool()
+        with self._lock:
+            if self._pool is None:
+                # No retries, so a dead node frees its fan-out worker once its timeout is up
+                self._pool = TransmissionClientPool(self.address, self.port, self.user, self.password,
+                                                    timeout=self.timeout, retries=1,
+                                                    backend="transmission:" + self.name)
+            return self._pool
+
+
+class NodeRegistry(object):
+    """
+    Nodes configured in variables.cfg. Without 'nodes' there's only the local node.
+
+        node_name=home                          name of the local node, 'local' by default
+        nodes=seedbox1,seedbox2                 remote nodes
+        node_timeout=5                          seconds to wait for each node's reply
+        node_seedbox1_transmission=host:9091
+        node_seedbox1_transmission_user=
+        node_seedbox1_transmission_password=
+        node_seedbox1_flexget_api_url=http://host:5050
+        node_seedbox1_flexget_api_token=
+    """
+    def __init__(self):
+        self._nodes = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix="node")
+
+    def nodes(self):
+        variables = Variables()
+        timeout = variables.get_int("node_timeout", NODE_TIMEOUT_SECONDS)
+        remote_names = [name.strip() for name in variables.get("nodes", "").split(",") if name.strip()]
+        local_name = variables.get("node_name") or LOCAL_NODE_NAME
+        tagged = bool(remote_names)
+        nodes = [self._node(local_name, True, tagged, (timeout,))]
+        for name in remote_names:
+            if not RE_NODE_NAME.match(name) or name in RESERVED_NODE_NAMES or name == local_name:
+                raise NodeConfigError("Bad node name: " + name)
+            prefix = "node_" + name + "_"
+            address, _, port = variables.get(prefix + "transmission", "").partition(":")
+            try:
+                port = int(port or 9091)
+            except ValueError:
+                raise NodeConfigError("Bad Transmission port for node {name}: {port}".format(name=name, port=port))
+            config = (timeout, address or name, port, variables.get(prefix + "transmission_user"),
+                      variables.get(prefix + "transmission_password"), variables.get(prefix + "flexget_api_url"),
+                      variables.get(prefix + "flexget_api_token"))
+            nodes.append(self._node(name, False, tagged, config))
+        return nodes
+
+    def _node(self, name, local, tagged, config):
+        # Nodes are kept while their configuration doesn't change so their connections are reused
+        key = (name, local, tagged, config)
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is None:
+                if local:
+                    node = Node(name, True, name if tagged else None, timeout=config[0])
+                else:
+                    timeout, address, port, user, password, flexget_api_url, flexget_api_token = config
+                    node = Node(name, False, name, address, port, user, password, flexget_api_url,
+                                flexget_api_token, timeout)
+                self._nodes[key] = node
+            return node
+
+    def get(self, name):
+        for node in self.nodes():
+            if node.name == name:
+                return node
+        raise ValueError("Unknown node: " + name)
+
+    def names(self):
+        return [node.name for node in self.nodes()]
+
+    def fan_out(self, function, nodes=None):
+        """
+        Calls function(node) on every node (or the given ones) concurrently and returns a NodeResult per node, in order.
+        Nodes that don't reply within their timeout are reported as such instead of holding up the others, and
+        nodes still busy with MAX_NODE_PENDING earlier calls aren't called, so they can't take all the workers.
+        A single node is called directly and its exceptions propagate, as they did before there were nodes.
+        """
+        nodes = self.nodes() if nodes is None else nodes
+        if len(nodes) == 1:
+            return [NodeResult(nodes[0], function(nodes[0]), None)]
+
+        futures = [(node, self._submit(function, node)) for node in nodes]
+        wait([future for node, future in futures if future is not None], timeout=max(node.timeout for node in nodes))
+        results = []
+        for node, future in futures:
+            if future is None:
+                results.append(NodeResult(node, None, "still busy with earlier requests"))
+            elif not future.done():
+                results.append(NodeResult(node, None, "no reply within {seconds}s".format(seconds=node.timeout)))
+            elif future.exception() is not None:
+                results.append(NodeResult(node, None, str(future.exception()) or type(future.exception()).__name__))
+            else:
+                results.append(NodeResult(node, future.result(), None))
+        return results
+
+    def _submit(self, function, node):
+        with self._lock:
+            if self._pending.get(node.name, 0) >= MAX_NODE_PENDING:
+                return None
+            self._pending[node.name] = self._pending.get(node.name, 0) + 1
+        future = self._executor.submit(function, node)
+        future.add_done_callback(lambda future: self._release(node.name))
+        return future
+
+    def _release(self, name):
+        with self._lock:
+            self._pending[name] -= 1
+
+    def pop_node_term(self, text):
+        """
+        Splits a leading 'node:NAME' term off text, returns (node, rest). Without one, the node is the local node.
+        """
+        words = text.split(None, 1)
+        if words and words[0].startswith("node:"):
+            return self.get(words[0][len("node:"):]), words[1] if len(words) > 1 else ""
+        return self.nodes()[0], text
+
+
+node_registry = NodeRegistry()
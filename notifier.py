@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+"""
+Notification service for Telegram and Pushbullet.
+
+    notifier.py --serve          listens on notify.sock, coalescing notifications into digests
+    notifier.py TITLE BODY       queues a notification, or sends it directly when the service isn't running
+"""
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from variables import Variables, join_path_to_script_directory
+from log_pipeline import configure_log
+from lazy_modules import requests
+from rendering import PARSE_MODE, Template, escape
+
+MAX_DATAGRAM_SIZE = 64 * 1024
+CLIENT_TIMEOUT_SECONDS = 5
+# A zero timeout would make the socket non-blocking
+MIN_WAIT_SECONDS = 0.01
+NOTIFICATION_TEMPLATE = Template('*{title}*: {body}')
+DIGEST_TEMPLATE = Template('*{title}* \\({count}\\)')
+
+
+def socket_path():
+    return Variables().get("notify_socket") or join_path_to_script_directory('notify.sock')
+
+
+class Notifier(object):
+    """
+    Delivers notifications over kept-alive HTTPS connections to every enabled channel.
+    """
+    TELEGRAM_URL = "https://api.telegram.org/bot{token}/sendMessage"
+    PUSHBULLET_URL = "https://api.pushbullet.com/v2/pushes"
+    TIMEOUT_SECONDS = 15
+
+    def __init__(self):
+        self.session = requests.Session()
+
+    def send(self, title, bodies):
+        variables = Variables()
+        if variables.get_bool("send_telegram"):
+            self._send_telegram(variables, title, bodies)
+        if variables.get_bool("send_pushbullet"):
+            self._send_pushbullet(variables, title, bodies)
+
+    def _send_telegram(self, variables, title, bodies):
+        from messaging import pack_messages
+        # Bodies are torrent names and the like, escaped so a stray _ or * can't get the whole digest rejected
+        if len(bodies) == 1:
+            items = [NOTIFICATION_TEMPLATE.render(title=title, body=bodies[0])]
+        else:
+            items = [DIGEST_TEMPLATE.render(title=title, count=len(bodies))]
+            items += [escape(body) for body in bodies]
+        url = self.TELEGRAM_URL.format(token=variables["telegram_token"])
+        for text in pack_messages(items, separator='\n'):
+            data = {'chat_id': variables["telegram_chat_id"], 'parse_mode': PARSE_MODE, 'text': text}
+            response = self.session.post(url, data=data, timeout=self.TIMEOUT_SECONDS)
+            if response.status_code == 429:
+                retry_after = response.json().get('parameters', {}).get('retry_after', 1)
+                logging.warning("Telegram rate limit hit, retrying in %ss", retry_after)
+                time.sleep(retry_after)
+                response = self.session.post(url, data=data, timeout=self.TIMEOUT_SECONDS)
+            if response.status_code != 200:
+                logging.error("Telegram notification failed: %s %s", response.status_code, response.text)
+
+    def _send_pushbullet(self, variables, title, bodies):
+        if len(bodies) > 1:
+            title = "{title} ({count})".format(title=title, count=len(bodies))
+        response = self.session.post(self.PUSHBULLET_URL, auth=(variables["pushbullet_token"], ''),
+                                     json={'type': 'note', 'title': title, 'body': '\n'.join(bodies)},
+                                     timeout=self.TIMEOUT_SECONDS)
+        if response.status_code != 200:
+            logging.error("Pushbullet notification failed: %s %s", response.status_code, response.text)
+
+
+class NotificationService(object):
+    """
+    Receives notifications as JSON datagrams on a Unix socket.
+    Notifications arriving within window_seconds of the first one are sent as a single digest per title.
+    """
+    def __init__(self, path, window_seconds, notifier):
+        self.path = path
+        self.window_seconds = window_seconds
+        self.notifier = notifier
+        self._pending = []
+        self._deadline = None
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        # Transmission's completion script usually runs as another user
+        os.chmod(self.path, 0o666)
+        logging.info("Listening on %s", self.path)
+        while True:
+            sock.settimeout(max(MIN_WAIT_SECONDS, self._deadline - time.monotonic()) if self._pending else None)
+            try:
+                self._receive(sock.recv(MAX_DATAGRAM_SIZE))
+            except socket.timeout:
+                pass
+            if self._pending and time.monotonic() >= self._deadline:
+                pending = self._pending
+                self._pending = []
+                # Delivery happens off the receiving loop so senders never wait on Telegram
+                threading.Thread(target=self._deliver, args=(pending,), daemon=True).start()
+
+    def _receive(self, data):
+        try:
+            notification = json.loads(data.decode('utf-8'))
+            title, body = notification['title'], notification['body']
+        except (ValueError, KeyError):
+            logging.warning("Ignoring malformed notification: %r", data)
+            return
+        if not self._pending:
+            self._deadline = time.monotonic() + self.window_seconds
+        self._pending.append((title, body))
+
+    def _deliver(self, notifications):
+        digests = {}
+        for title, body in notifications:
+            digests.setdefault(title, []).append(body)
+        for title, bodies in digests.items():
+            try:
+                self.notifier.send(title, bodies)
+            except Exception:
+                logging.exception("Failed to deliver %d '%s' notifications", len(bodies), title)
+
+
+def notify(title, body):
+    """
+    Queues a notification with the service, sending it directly if the service isn't listening.
+    """
+    data = json.dumps({'title': title, 'body': body}).encode('utf-8')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.settimeout(CLIENT_TIMEOUT_SECONDS)
+    try:
+        sock.sendto(data, socket_path())
+        return
+    except OSError as e:
+        logging.warning("Notification service unavailable (%s), sending directly", e)
+    finally:
+        sock.close()
+    Notifier().send(title, [body])
+
+
+def main():
+    if sys.argv[1:] == ['--serve']:
+        configure_log("notifier")
+        service = NotificationService(socket_path(), Variables().get_int("notify_window_seconds", 10), Notifier())
+        service.serve_forever()
+    elif len(sys.argv) == 3:
+        notify(sys.argv[1], sys.argv[2])
+    else:
+        print(__doc__.strip())
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
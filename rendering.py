@@ -0,0 +1,124 @@
+"""
+Rendering of status replies in Telegram's MarkdownV2.
+
+Templates are written in MarkdownV2 and compiled once, every value is escaped when it's rendered,
+so torrent names, task names and errors can't break a reply's markup.
+"""
+
+import string
+from bisect import bisect_right
+from itertools import islice
+
+PARSE_MODE = 'MarkdownV2'
+# The backslash comes first, so the backslashes added for the others aren't escaped again
+SPECIAL_CHARACTERS = '\\_*[]()~`>#+-=|{}.!'
+_ESCAPED_CHARACTERS = tuple((character, '\\' + character) for character in SPECIAL_CHARACTERS)
+# Joins a template's values so they're escaped in one pass, it can't appear in MarkdownV2 text
+_SEPARATOR = '\x00'
+# Rows escaped together by Template.render_rows, small enough that a page doesn't render much past its end
+ROWS_PER_BATCH = 32
+_CODE_ESCAPES = str.maketrans({'\\': '\\\\', '`': '\\`'})
+
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+_SIZE_DIVISORS = tuple(1024 ** exponent for exponent in range(len(SIZE_UNITS)))
+_SIZE_THRESHOLDS = _SIZE_DIVISORS[1:]
+DURATION_UNITS = (('year', 365 * 24 * 60 * 60), ('day', 24 * 60 * 60), ('hour', 60 * 60), ('minute', 60),
+                  ('second', 1))
+_DURATION_NAMES = {name: (name, name + 's') for name, length in DURATION_UNITS}
+
+
+def escape(value):
+    # A replace per special character present beats str.translate, whose mapping to two characters is slow
+    text = str(value)
+    for character, escaped in _ESCAPED_CHARACTERS:
+        if character in text:
+            text = text.replace(character, escaped)
+    return text
+
+
+def escape_code(value):
+    """
+    Escapes text for use inside `code` or ```pre``` entities, where only ` and \\ are special.
+    """
+    return str(value).translate(_CODE_ESCAPES)
+
+
+class Template(object):
+    """
+    A str.format style template in MarkdownV2, e.g. Template('*{name}* \\\\| {size}').
+    It's compiled once into a positional format string. Rendering escapes all the values in one pass over them joined
+    and formats them in one call, render_rows does the same for a batch of rows at a time.
+    """
+    __slots__ = ('source', '_format', '_fields')
+
+    def __init__(self, source):
+        self.source = source
+        compiled = []
+        fields = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(source):
+            compiled.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+            if not field.isidentifier() or format_spec or conversion:
+                raise ValueError("Only plain {name} fields are supported: " + source)
+            compiled.append('{' + str(len(fields)) + '}')
+            fields.append(field)
+        self._format = ''.join(compiled).format
+        self._fields = tuple(fields)
+
+    def render(self, **values):
+        texts = [str(values[field]) for field in self._fields]
+        joined = _SEPARATOR.join(texts)
+        if joined.count(_SEPARATOR) != len(texts) - 1:
+            # A value holds the separator itself
+            return self._format(*map(escape, texts))
+        return self._format(*escape(joined).split(_SEPARATOR))
+
+    def render_rows(self, rows):
+        """
+        Yields the rendering of each dict of values in rows, consuming rows only ROWS_PER_BATCH ahead.
+        """
+        rows = iter(rows)
+        fields = self._fields
+        width = len(fields)
+        while True:
+            batch = list(islice(rows, ROWS_PER_BATCH))
+            if not batch:
+                return
+            texts = [str(values[field]) for values in batch for field in fields]
+            joined = _SEPARATOR.join(texts)
+            if joined.count(_SEPARATOR) != len(texts) - 1:
+                for values in batch:
+                    yield self.render(**values)
+                continue
+            parts = escape(joined).split(_SEPARATOR)
+            for start in range(0, len(parts), width):
+                yield self._format(*parts[start:start + width])
+
+
+def file_size(size):
+    if size == 0:
+        return '0B'
+    index = bisect_right(_SIZE_THRESHOLDS, size)
+    return '%s %s' % (round(size / _SIZE_DIVISORS[index], 2), SIZE_UNITS[index])
+
+
+def duration(delta, precision=2):
+    """
+    Describes a timedelta in its precision largest non-zero units, e.g. '2 days, 3 hours'.
+    """
+    remaining = int(abs(delta).total_seconds())
+    parts = []
+    for name, length in DURATION_UNITS:
+        if remaining < length:
+            continue
+        value, remaining = divmod(remaining, length)
+        parts.append('{value} {name}'.format(value=value, name=_DURATION_NAMES[name][value != 1]))
+        if len(parts) == precision:
+            break
+    return ', '.join(parts)
+
+
+def time_ago(delta, precision=2):
+    description = duration(delta, precision)
+    return description + " ago" if description else "just now"
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+"""
+Micro-benchmark of rendering.py against the str.format based formatters it replaced.
+
+    rendering_benchmark.py [ROWS]
+
+"first page" is /torrents /list with ROWS torrents: legacy rendered and packed every row to send the first page,
+now the rows are rendered as they're packed and only as far as the page goes.
+"""
+
+import math
+import sys
+import timeit
+from datetime import timedelta
+from messaging import page_of, pack_messages
+from rendering import Template, file_size, time_ago
+
+TORRENT_TEMPLATE = Template('\\[{key}\\] *{name}*\n{status} \\| Size: {size} \\| {progress}%\nD/L:{rate} \\| ETA:{eta}')
+REPEAT = 7
+
+
+def legacy_file_size(size):
+    if size == 0:
+        return '0B'
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+    i = int(math.floor(math.log(size, 1024)))
+    p = math.pow(1024, i)
+    s = round(size / p, 2)
+    return '%s %s' % (s, size_name[i])
+
+
+def legacy_time_ago(timedelta, precision=2):
+    units = ('year', 'day', 'hour', 'minute', 'second', 'microsecond')
+
+    delta = abs(timedelta)
+    delta_dict = {
+        'year': int(delta.days / 365),
+        'day': int(delta.days % 365),
+        'hour': int(delta.seconds / 3600),
+        'minute': int(delta.seconds / 60) % 60,
+        'second': delta.seconds % 60,
+    }
+
+    hlist = []
+    count = 0
+
+    for unit in units:
+        if count >= precision:
+            break
+        unit_value = delta_dict.get(unit, 0)
+        if unit_value == 0:
+            continue
+        s = '' if unit_value == 1 else 's'
+        hlist.append('{} {}{}'.format(delta_dict[unit], unit, s))
+        count += 1
+
+    return format(', '.join(hlist)) + " ago"
+
+
+def legacy_torrent(torrent):
+    return '\\[{id}] *{name}*\n{status} | Size: {size} | {progress}%\nD/L:{dl_rate} | ETA:{eta}'\
+        .format(id=torrent['key'], name=torrent['name'], status=torrent['status'],
+                size=legacy_file_size(torrent['total_size']), progress=round(torrent['progress'], 2),
+                eta=torrent['eta'], dl_rate=(legacy_file_size(torrent['rate']))+"/s")
+
+
+def torrent_values(torrent):
+    return {'key': torrent['key'], 'name': torrent['name'], 'status': torrent['status'],
+            'size': file_size(torrent['total_size']), 'progress': round(torrent['progress'], 2),
+            'rate': file_size(torrent['rate']) + "/s", 'eta': torrent['eta']}
+
+
+def torrent_rows(torrents):
+    return TORRENT_TEMPLATE.render_rows(torrent_values(torrent) for torrent in torrents)
+
+
+def fake_torrents(count):
+    return [{'key': index, 'name': 'Some_Linux_ISO.v{index}.[x86_64]*'.format(index=index), 'status': 'downloading',
+             'total_size': 1234567 * (index + 1), 'progress': index % 100 + 0.123, 'rate': 4567 * index,
+             'eta': '{minutes}m'.format(minutes=index % 60)} for index in range(count)]
+
+
+def best_of(legacy, new, number):
+    """
+    Best time per call of each function, their runs alternating so both see the same machine load.
+    """
+    legacy_times = []
+    new_times = []
+    for repeat in range(REPEAT):
+        legacy_times.append(timeit.timeit(legacy, number=number))
+        new_times.append(timeit.timeit(new, number=number))
+    return min(legacy_times) / number, min(new_times) / number
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    torrents = fake_torrents(rows)
+    sizes = [0, 1, 1023, 1024, 1536, 10 ** 6, 1024 ** 3, 5 * 1024 ** 4 + 17] + [t['total_size'] for t in torrents]
+    deltas = [timedelta(seconds=seconds) for seconds in (1, 59, 61, 3600, 3661, 86400 * 400 + 5, 7 * 86400)]
+
+    mismatches = [size for size in sizes if file_size(size) != legacy_file_size(size)]
+    mismatches += [delta for delta in deltas if time_ago(delta) != legacy_time_ago(delta)]
+    print("Output differences: {mismatches}".format(mismatches=mismatches or "none"))
+
+    cases = [
+        ("file size", lambda: [legacy_file_size(size) for size in sizes],
+         lambda: [file_size(size) for size in sizes], len(sizes)),
+        ("time ago", lambda: [legacy_time_ago(delta) for delta in deltas],
+         lambda: [time_ago(delta) for delta in deltas], len(deltas)),
+        ("torrent rows", lambda: [legacy_torrent(t) for t in torrents],
+         lambda: list(torrent_rows(torrents)), len(torrents)),
+        ("first page", lambda: page_of(list(pack_messages([legacy_torrent(t) for t in torrents])), 1),
+         lambda: page_of(pack_messages(torrent_rows(torrents)), 1), 1),
+    ]
+    print("{case:<14}{legacy:>14}{new:>14}{speedup:>10}".format(
+        case="", legacy="legacy ns/op", new="new ns/op", speedup="speedup"))
+    for name, legacy, new, operations in cases:
+        legacy_time, new_time = [seconds / operations * 1e9 for seconds in best_of(legacy, new, 20)]
+        print("{name:<14}{legacy:>14.0f}{new:>14.0f}{speedup:>9.2f}x".format(
+            name=name, legacy=legacy_time, new=new_time, speedup=legacy_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+import telepot.exception
+
+SESSION_IDLE_SECONDS = 15
+SWEEP_INTERVAL_SECONDS = 5
+
+
+class Session(object):
+    def __init__(self, chat_id, conversation):
+        self.chat_id = chat_id
+        self.conversation = conversation
+        self.last_active = time.monotonic()
+        # Messages queued or being handled, a busy session is never idle
+        self.pending = 0
+        # Set when the conversation closed itself and no message arrived since
+        self.closed = False
+
+
+class SessionStore(object):
+    """
+    Conversations by chat id, in place of a delegate thread per chat.
+    A chat's messages are handled in order on the worker pool. When a conversation closes itself the chat starts over
+    with a new one. Sessions idle for idle_seconds are evicted, calling on_evict(conversation) unless it had closed.
+    """
+    def __init__(self, conversation_factory, worker_pool, idle_seconds=SESSION_IDLE_SECONDS, on_evict=None):
+        self.conversation_factory = conversation_factory
+        self.worker_pool = worker_pool
+        self.idle_seconds = idle_seconds
+        self.on_evict = on_evict
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def dispatch(self, msg):
+        chat_id = msg['chat']['id']
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is None:
+                session = self._sessions[chat_id] = Session(chat_id, self.conversation_factory(chat_id))
+            session.pending += 1
+            session.closed = False
+            session.last_active = time.monotonic()
+        if not self.worker_pool.submit(chat_id, self._handle, session, msg):
+            logging.warning("Dropping a message from chat {chat_id}, too many are queued".format(chat_id=chat_id))
+            self._done(session)
+
+    def _handle(self, session, msg):
+        try:
+            session.conversation.on_chat_message(msg)
+        except telepot.exception.StopListening:
+            # Messages already queued go to the new conversation, in order
+            conversation = self.conversation_factory(session.chat_id)
+            with self._lock:
+                session.conversation = conversation
+                session.closed = session.pending == 1
+        finally:
+            self._done(session)
+
+    def _done(self, session):
+        with self._lock:
+            session.pending -= 1
+            session.last_active = time.monotonic()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def evict_idle(self):
+        idle_since = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = [session for session in self._sessions.values()
+                    if not session.pending and session.last_active < idle_since]
+            for session in idle:
+                del self._sessions[session.chat_id]
+        for session in idle:
+            if self.on_evict is not None and not session.closed:
+                try:
+                    self.on_evict(session.conversation)
+                except Exception:
+                    logging.exception("Failed evicting the session of chat {chat_id}".format(
+                                      chat_id=session.chat_id))
+        return len(idle)
+
+    def start_sweeper(self, interval=SWEEP_INTERVAL_SECONDS):
+        def run():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        thread = threading.Thread(target=run, name="session-sweeper", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,181 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from messaging import MAX_MESSAGE_LENGTH
+
+DEFAULT_TIMEOUT_SECONDS = 10 * 60
+EDIT_INTERVAL_SECONDS = 2
+READ_SIZE = 4096
+
+command_executor = ThreadPoolExecutor(max_workers=4)
+_running_commands = {}
+_running_commands_lock = threading.Lock()
+
+
+class ShellCommand(object):
+    """
+    A shell command in its own process group, killed when it times out or is cancelled.
+    """
+    def __init__(self, command, timeout=DEFAULT_TIMEOUT_SECONDS):
+        self.command = command
+        self.timeout = timeout
+        self.timed_out = False
+        self.cancelled = False
+        self.process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+        self._timer = threading.Timer(timeout, self._on_timeout)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timeout(self):
+        logging.warning("Command timed out after {timeout}s: {command}".format(timeout=self.timeout,
+                                                                               command=self.command))
+        self.timed_out = True
+        self.kill()
+
+    def cancel(self):
+        self.cancelled = True
+        self.kill()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def read(self):
+        """
+        Returns whatever output is available, blocking until there is some. Empty bytes means EOF.
+        """
+        return self.process.stdout.read1(READ_SIZE)
+
+    def wait(self):
+        return_code = self.process.wait()
+        self._timer.cancel()
+        self.process.stdout.close()
+        return return_code
+
+    def status(self, return_code):
+        if self.cancelled:
+            return "Cancelled"
+        if self.timed_out:
+            return "Timed out after {timeout} seconds".format(timeout=self.timeout)
+        if return_code != 0:
+            return "Exited with code {code}".format(code=return_code)
+        return None
+
+
+class _PipeWithPrefix(object):
+    """
+    File-like object yielding output already read from a command followed by the rest of its pipe.
+    """
+    def __init__(self, prefix, shell_command):
+        self.prefix = prefix
+        self.shell_command = shell_command
+
+    def read(self, size=-1):
+        if self.prefix:
+            data = self.prefix if size < 0 else self.prefix[:size]
+            self.prefix = self.prefix[len(data):]
+            if size < 0:
+                data += self.shell_command.process.stdout.read()
+            return data
+        if size < 0:
+            return self.shell_command.process.stdout.read()
+        return self.shell_command.read()
+
+
+def run_shell_command(command, timeout=DEFAULT_TIMEOUT_SECONDS):
+    shell_command = ShellCommand(command, timeout)
+    output = shell_command.process.stdout.read()
+    return_code = shell_command.wait()
+    if shell_command.timed_out:
+        output += "\n{status}".format(status=shell_command.status(return_code)).encode('utf-8')
+    return return_code, str(output, 'utf-8', 'replace')
+
+
+def cancel_shell_commands(chat_id):
+    with _running_commands_lock:
+        commands = _running_commands.pop(chat_id, set())
+    for shell_command in commands:
+        shell_command.cancel()
+    return len(commands)
+
+
+def submit_shell_command_reply(command, bot, timeout=DEFAULT_TIMEOUT_SECONDS, guard=None):
+    """
+    Runs command on the command executor, so the chat stays responsive to /cancel while it runs.
+    bot needs sender, chat_id and editor(sent_message). guard() is a context manager the command runs in.
+    """
+    command_executor.submit(_reply_shell_command, command, bot, timeout, guard or nullcontext)
+
+
+def _reply_shell_command(command, bot, timeout, guard):
+    with guard():
+        _run_shell_command_reply(command, bot, timeout)
+
+
+def _run_shell_command_reply(command, bot, timeout):
+    try:
+        shell_command = ShellCommand(command, timeout)
+    except OSError:
+        logging.exception("Failed to start " + command)
+        bot.sender.sendMessage("Failed to start command")
+        return
+
+    with _running_commands_lock:
+        _running_commands.setdefault(bot.chat_id, set()).add(shell_command)
+    try:
+        _stream_reply(shell_command, bot)
+    except Exception:
+        logging.exception("Failed to reply output of " + command)
+        shell_command.kill()
+    finally:
+        with _running_commands_lock:
+            _running_commands.get(bot.chat_id, set()).discard(shell_command)
+
+
+def _stream_reply(shell_command, bot):
+    # Short output is shown in one message edited as it grows, long output is uploaded from the pipe
+    output = b''
+    editor = None
+    shown = None
+    last_edit = 0
+    while True:
+        chunk = shell_command.read()
+        if not chunk:
+            break
+        output += chunk
+        if len(output) > MAX_MESSAGE_LENGTH:
+            bot.sender.sendDocument(('output.txt', _PipeWithPrefix(output, shell_command)))
+            output = None
+            break
+        if time.monotonic() - last_edit >= EDIT_INTERVAL_SECONDS:
+            shown = output.decode('utf-8', 'replace')
+            if editor is None:
+                editor = bot.editor(bot.sender.sendMessage(shown))
+            else:
+                editor.editMessageText(shown)
+            last_edit = time.monotonic()
+
+    status = shell_command.status(shell_command.wait())
+    if output is None:
+        if status:
+            bot.sender.sendMessage(status)
+        return
+
+    text = output.decode('utf-8', 'replace') or "(no output)"
+    if status:
+        if len(text) + len(status) + 1 <= MAX_MESSAGE_LENGTH:
+            text += "\n" + status
+        else:
+            bot.sender.sendMessage(status)
+    if editor is None:
+        bot.sender.sendMessage(text)
+    elif text != shown:
+        editor.editMessageText(text)
@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+
+class Snapshot(object):
+    __slots__ = ('value', 'taken_at', 'duration')
+
+    def __init__(self, value, taken_at, duration):
+        self.value = value
+        self.taken_at = taken_at
+        self.duration = duration
+
+    def age(self):
+        return time.time() - self.taken_at
+
+
+class SnapshotStore(object):
+    """
+    Keeps the latest result of each registered subsystem, refreshed by a background thread per subsystem.
+    """
+    def __init__(self):
+        self._refreshers = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def register(self, name, refresh, interval):
+        self._refreshers[name] = (refresh, interval)
+
+    def names(self):
+        return list(self._refreshers)
+
+    def get(self, name):
+        with self._lock:
+            return self._snapshots.get(name)
+
+    def invalidate(self, name):
+        with self._lock:
+            self._snapshots.pop(name, None)
+
+    def refresh(self, name):
+        refresh, interval = self._refreshers[name]
+        started_at = time.time()
+        value = refresh()
+        snapshot = Snapshot(value, time.time(), time.time() - started_at)
+        with self._lock:
+            self._snapshots[name] = snapshot
+        return snapshot
+
+    def start(self):
+        for name in self._refreshers:
+            thread = threading.Thread(target=self._poll, args=(name,), name="snapshot-" + name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _poll(self, name):
+        refresh, interval = self._refreshers[name]
+        while not self._stopped.is_set():
+            try:
+                self.refresh(name)
+            except Exception:
+                logging.exception("Failed to refresh the {name} snapshot".format(name=name))
+            self._stopped.wait(interval)
+
+
+snapshot_store = SnapshotStore()
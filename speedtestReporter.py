@@ -1,48 +1,71 @@
 #!/usr/bin/python3
 
 import logging
-import logging.handlers
-import speedtest
-import thingspeak
 import traceback
 import json
-import os
-from variables import Variables
+import sys
+from variables import Variables, join_path_to_script_directory
+from log_pipeline import configure_log
+from metrics import SPEEDTEST_DOWNLOAD_SERIES, SPEEDTEST_PING_SERIES, SPEEDTEST_UPLOAD_SERIES, metrics_store
+from thingspeak_spool import SampleSpool, ThingSpeakBulkUploader
 
 
-rootLogger = logging.getLogger('')
-rootLogger.setLevel(logging.INFO)
+SPOOL_PATH = join_path_to_script_directory('spool/speedtest.jsonl')
 
-def join_path_to_script_directory(path):
-    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
 
-def configure_log():
-    root = logging.getLogger()
-    log_file_name = join_path_to_script_directory('logs/speedtestReporter.log')
-    h = logging.handlers.RotatingFileHandler(log_file_name, maxBytes=1024*1024, backupCount=5)
-    f = logging.Formatter('%(asctime)s %(name)s %(levelname)-8s %(message)s')
-    h.setFormatter(f)
-    root.addHandler(h)
+def record_speedtest(ping, download, upload):
+    try:
+        metrics_store.record(SPEEDTEST_PING_SERIES, ping)
+        metrics_store.record(SPEEDTEST_DOWNLOAD_SERIES, download)
+        metrics_store.record(SPEEDTEST_UPLOAD_SERIES, upload)
+    except OSError:
+        logging.exception("Failed to record the speedtest locally")
 
-def main():
-    configure_log()
 
-    global channel
+def report(ping, download, upload):
+    logging.info('Ping %dms; Download: %2f; Upload %2f', ping, download, upload)
+    record_speedtest(ping, download, upload)
+
+    variables = Variables()
+    channel_id = variables.get_int("thingspeak_speedtest_channel")
+    write_key = variables["thingspeak_writekey"]
 
+    spool = SampleSpool(SPOOL_PATH)
+    spool.append({'field1': ping, 'field2': download, 'field3': upload})
+    uploader = ThingSpeakBulkUploader(channel_id, write_key, variables.get("thingspeak_url"))
     try:
-        variables = Variables()
+        uploaded = spool.flush(uploader.upload, uploader.BATCH_SIZE)
+    except IOError:
+        logging.exception("Upload failed, samples stay spooled")
+        return
+    logging.info('Uploaded %d samples to ThingSpeak', uploaded)
+    print('Uploaded {count} samples'.format(count=uploaded))
+
+
+def run_daemon():
+    from speedtest_daemon import SpeedtestDaemon
+
+    variables = Variables()
+    daemon = SpeedtestDaemon(report,
+                             interval=variables.get_int("speedtest_interval", 60 * 60),
+                             samples=variables.get_int("speedtest_samples", 1),
+                             busy_mbit=variables.get_int("speedtest_busy_mbit", 2))
+    daemon.run_forever()
 
-        channel_id = variables["thingspeak_speedtest_channel"]
-        write_key = variables["thingspeak_writekey"]
+
+def main():
+    import speedtest
+
+    configure_log("speedtestReporter")
+    try:
+        if '--daemon' in sys.argv[1:]:
+            run_daemon()
+            return
 
         ping, download, upload, server = speedtest.test_speed(timeout=30, secure=True)
         download = download /(1000.0*1000.0)*8
         upload = upload /(1000.0*1000.0)*8
-
-        logging.info('Ping %dms; Download: %2f; Upload %2f', ping, download, upload)
-        channel = thingspeak.Channel(id=channel_id, write_key=write_key)
-        response = channel.update({1: ping, 2: download, 3: upload})
-        print(response)
+        report(ping, download, upload)
     except KeyboardInterrupt:
         print('\nCancelling...')
         speedtest.cancel_test()
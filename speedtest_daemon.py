@@ -0,0 +1,65 @@
+import logging
+import statistics
+import time
+import speedtest
+import transmissionrpc
+from transmission_client import shared_pool
+
+
+class SpeedtestDaemon(object):
+    """
+    Runs speedtests on a schedule, postponing them while Transmission is using the link.
+    Results are the median of samples runs one after the other, passed to report(ping, download, upload) in ms and
+    Mbit/s. Staying up saves a fresh interpreter and the speedtest import on every run.
+    """
+    TIMEOUT_SECONDS = 30
+    BUSY_RETRY_SECONDS = 5 * 60
+
+    def __init__(self, report, interval=60 * 60, samples=1, busy_mbit=2):
+        self.report = report
+        self.interval = interval
+        self.samples = max(1, samples)
+        self.busy_mbit = busy_mbit
+
+    def run_forever(self):
+        busy_delay = self.BUSY_RETRY_SECONDS
+        while True:
+            if self._is_link_busy():
+                logging.info("Transmission is busy, postponing the speedtest by %ds", busy_delay)
+                time.sleep(busy_delay)
+                busy_delay = min(busy_delay * 2, self.interval)
+                continue
+            busy_delay = self.BUSY_RETRY_SECONDS
+
+            try:
+                self.report(*self.measure())
+            except Exception:
+                logging.exception("Speedtest failed")
+            time.sleep(self.interval)
+
+    def _is_link_busy(self):
+        try:
+            stats = shared_pool().rpc('session-stats')
+        except transmissionrpc.TransmissionError:
+            return False
+        rate_mbit = (stats['downloadSpeed'] + stats['uploadSpeed']) * 8 / (1000.0 * 1000.0)
+        return rate_mbit > self.busy_mbit
+
+    def measure(self):
+        # The speedtest module picks the closest server by itself on every run, so there's no server list to keep
+        # and repeated runs stand in for measuring against several servers
+        results = []
+        for _ in range(self.samples):
+            try:
+                results.append(self._measure_once())
+            except Exception:
+                logging.exception("Speedtest run failed")
+        if not results:
+            raise IOError("All {count} speedtest runs failed".format(count=self.samples))
+        pings, downloads, uploads = zip(*results)
+        return statistics.median(pings), statistics.median(downloads), statistics.median(uploads)
+
+    def _measure_once(self):
+        ping, download, upload, server = speedtest.test_speed(timeout=self.TIMEOUT_SECONDS, secure=True)
+        logging.info("Speedtest against %s: ping %dms", server, ping)
+        return ping, download / (1000.0 * 1000.0) * 8, upload / (1000.0 * 1000.0) * 8
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from variables import Variables  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def config(monkeypatch):
+    """
+    Stands in for variables.cfg in every test, tests fill in the values they need.
+    """
+    values = {}
+    monkeypatch.setattr(Variables, '_load', classmethod(lambda cls: values))
+    return values
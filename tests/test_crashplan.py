@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+from benchmark import FakeHTTPServer
+from crashplan import Crashplan
+
+
+class StubCrashplan(FakeHTTPServer):
+    """
+    Crashplan API replying 304 to requests carrying the current ETag, which it doesn't repeat in the 304.
+    """
+    ETAG = '"v1"'
+
+    def __init__(self):
+        self.delay = 0
+        self.validators = []
+        self.validators_lock = threading.Lock()
+        super(StubCrashplan, self).__init__()
+
+    def handle(self, method, path, headers, body):
+        route = path.split('?')[0]
+        self.count(route)
+        with self.validators_lock:
+            self.validators.append(headers.get('If-None-Match'))
+        time.sleep(self.delay)
+        if headers.get('If-None-Match') == self.ETAG:
+            return 304, {}, None
+        if route == '/api/Account/my':
+            payload = {'data': {'accountId': 42}}
+        elif route == '/api/Subscription':
+            payload = {'data': [{'name': 'Plan', 'expirationDate': '2999-01-01T00:00:00'}]}
+        else:
+            payload = {'data': {'computers': [{'name': 'laptop', 'lastConnected': '2024-01-01T00:00:00',
+                                               'backupUsage': [{'selectedBytes': 100, 'todoBytes': 25,
+                                                                'selectedFiles': 3,
+                                                                'lastCompletedBackup': '2024-01-01T00:00:00'}]}]}}
+        return 200, {'ETag': self.ETAG}, payload
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = StubCrashplan()
+    monkeypatch.setattr(Crashplan, 'BASE_API_URL', server.url + '/api/')
+    yield server
+    server.close()
+
+
+def test_account_id_and_responses_are_cached(stub):
+    crashplan = Crashplan('user', 'password')
+    subscription, computers = crashplan.get_subscription_and_computers()
+    assert subscription.name == 'Plan'
+    assert [computer.percentComplete for computer in computers] == [75.0]
+    requests_made = stub.request_count()
+
+    crashplan.get_subscription_and_computers()
+    assert stub.request_count() == requests_made
+    assert stub.requests['/api/Account/my'] == 1
+
+
+def test_subscription_and_computers_are_fetched_concurrently(stub):
+    crashplan = Crashplan('user', 'password')
+    crashplan.get_account_id()
+    stub.delay = 0.3
+    started_at = time.monotonic()
+    crashplan.get_subscription_and_computers()
+    assert time.monotonic() - started_at < 0.55
+
+
+def test_expired_responses_are_revalidated(stub, monkeypatch):
+    monkeypatch.setattr(Crashplan, 'CACHE_TTL_SECONDS', 0)
+    crashplan = Crashplan('user', 'password')
+    url = Crashplan.BASE_API_URL + 'Account/my'
+    data = crashplan.fetch_url_json(url)
+    assert crashplan.fetch_url_json(url) == data
+    assert crashplan.fetch_url_json(url) == data
+    # The ETag is kept through the 304s, which don't repeat it
+    assert stub.validators == [None, StubCrashplan.ETAG, StubCrashplan.ETAG]
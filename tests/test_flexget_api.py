@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from benchmark import FakeFlexgetAPI, write_fake_flexget
+from flexget_api import FlexgetAPI, FlexgetAPIError, FlexgetUnavailableError
+from flexget_status import parse_time
+
+
+@pytest.fixture
+def daemon():
+    server = FakeFlexgetAPI(6)
+    yield server
+    server.close()
+
+
+def test_status_looks_up_last_successes_once_per_run(daemon):
+    api = FlexgetAPI(daemon.url)
+    statuses = api.status()
+    assert [status.name for status in statuses] == ['benchmark_task_{index}'.format(index=index) for index in range(6)]
+    # Tasks 0 and 3 failed their last run
+    assert statuses[0].last_success == parse_time(daemon.last_success)
+    assert statuses[1].last_success == statuses[1].last_execution
+    assert daemon.requests['executions'] == 2
+
+    api.status()
+    assert daemon.requests['executions'] == 2
+
+
+def test_a_new_run_replaces_the_cached_last_success(daemon):
+    api = FlexgetAPI(daemon.url)
+    api.status()
+    daemon.tasks[0]['last_execution'] = {'start': (datetime.now() + timedelta(minutes=5)).isoformat(),
+                                         'succeeded': False}
+    api.status()
+    assert daemon.requests['executions'] == 3
+    assert len([key for key in FlexgetAPI._last_successes if key[0] == api.base_url]) == 2
+
+
+def test_execute_returns_the_started_tasks(daemon):
+    api = FlexgetAPI(daemon.url)
+    assert api.execute('benchmark_task_1') == ['benchmark_task_1']
+    assert api.execute('missing') == []
+
+
+def test_errors(daemon):
+    with pytest.raises(FlexgetAPIError, match='Not found'):
+        FlexgetAPI(daemon.url + '/missing').status()
+    closed = FakeFlexgetAPI(0)
+    closed.close()
+    with pytest.raises(FlexgetUnavailableError):
+        FlexgetAPI(closed.url, timeout=1).status()
+
+
+def test_bot_falls_back_to_the_cli(config, tmp_path):
+    from bot import Flexget
+
+    closed = FakeFlexgetAPI(0)
+    closed.close()
+    config.update({'flexget_api_url': closed.url, 'flexget_path': write_fake_flexget(str(tmp_path), 2)})
+    rows = Flexget().list()
+    assert len(rows) == 2 and rows[0].startswith('*benchmark\\_task\\_0*')
+
+
+def test_bot_executes_through_the_api(config, daemon):
+    from bot import Flexget
+
+    config['flexget_api_url'] = daemon.url
+    assert Flexget().execute('benchmark_task_1', None) == "Started benchmark_task_1"
@@ -0,0 +1,30 @@
+import pytest
+
+from import_report import import_times, total_ms
+
+# Generous for a Raspberry Pi, importing bot takes about 100ms on a desktop
+BUDGET_MS = 1000
+DEFERRED_MODULES = ('psutil', 'requests', 'transmissionrpc')
+
+
+@pytest.fixture(scope='module')
+def times():
+    return import_times('bot')
+
+
+def test_bot_imports_within_budget(times):
+    assert total_ms(times, 'bot') <= BUDGET_MS
+
+
+def test_backend_clients_are_imported_on_first_use(times):
+    imported = set(t.module for t in times)
+    assert not imported.intersection(DEFERRED_MODULES)
+
+
+def test_lazy_module_imports_on_first_attribute():
+    from lazy_modules import LazyModule
+
+    json = LazyModule('json')
+    assert json._module is None
+    assert json.loads('[1]') == [1]
+    assert json._module is not None
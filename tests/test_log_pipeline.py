@@ -0,0 +1,43 @@
+import json
+import logging
+
+import pytest
+
+import log_pipeline
+
+
+@pytest.fixture
+def log_file(tmp_path, monkeypatch):
+    """
+    Configures logging into tmp_path and returns a function reading back the records written so far.
+    """
+    root = logging.getLogger()
+    level = root.level
+    (tmp_path / 'logs').mkdir()
+    monkeypatch.setattr(log_pipeline, 'join_path_to_script_directory', lambda path: str(tmp_path / path))
+
+    def records():
+        log_pipeline.stop_log()
+        with open(str(tmp_path / 'logs' / 'test.log')) as f:
+            return [json.loads(line) for line in f]
+
+    yield records
+    log_pipeline.stop_log()
+    root.setLevel(level)
+
+
+def test_log_level_is_case_insensitive(config, log_file):
+    config['log_level'] = 'debug'
+    log_pipeline.configure_log('test')
+    assert logging.getLogger().level == logging.DEBUG
+    assert log_file() == []
+
+
+def test_bad_values_fall_back_to_defaults_with_a_warning(config, log_file):
+    config.update({'log_level': 'loud', 'log_sample_backend': 'often', 'log_max_bytes': '1MB'})
+    log_pipeline.configure_log('test')
+    assert logging.getLogger().level == logging.INFO
+    messages = [record['message'] for record in log_file()]
+    assert messages == ["Bad log_sample_backend in variables.cfg: often, using 10",
+                        "Bad log_max_bytes in variables.cfg: 1MB, using {size}".format(size=log_pipeline.MAX_BYTES),
+                        "Bad log_level in variables.cfg: loud, using INFO"]
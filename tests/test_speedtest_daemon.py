@@ -0,0 +1,49 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+
+class FakeSpeedtest(types.ModuleType):
+    """
+    The speedtest submodule's test_speed(), replying with the queued results (bytes/s) or raising queued errors.
+    """
+    def __init__(self, results):
+        super(FakeSpeedtest, self).__init__('speedtest')
+        self.results = list(results)
+        self.calls = []
+
+    def test_speed(self, timeout, secure):
+        self.calls.append((timeout, secure))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def daemon_with(monkeypatch, results, samples):
+    fake = FakeSpeedtest(results)
+    # The submodule may not be checked out, the fake stands in for it on import too
+    monkeypatch.setitem(sys.modules, 'speedtest', fake)
+    speedtest_daemon = importlib.import_module('speedtest_daemon')
+    monkeypatch.setattr(speedtest_daemon, 'speedtest', fake)
+    return speedtest_daemon.SpeedtestDaemon(lambda *result: None, samples=samples), fake
+
+
+def test_reports_the_median_of_the_runs_in_mbit(monkeypatch):
+    daemon, fake = daemon_with(monkeypatch, [(30, 1250000, 125000, 'a'), (10, 2500000, 250000, 'b'),
+                                             (20, 3750000, 375000, 'c')], samples=3)
+    assert daemon.measure() == (20, 20.0, 2.0)
+    assert fake.calls == [(daemon.TIMEOUT_SECONDS, True)] * 3
+
+
+def test_failed_runs_are_left_out(monkeypatch):
+    daemon, fake = daemon_with(monkeypatch, [IOError("no server"), (10, 1250000, 125000, 'a')], samples=2)
+    assert daemon.measure() == (10, 10.0, 1.0)
+
+
+def test_raises_when_every_run_fails(monkeypatch):
+    daemon, fake = daemon_with(monkeypatch, [IOError("no server")], samples=1)
+    with pytest.raises(IOError):
+        daemon.measure()
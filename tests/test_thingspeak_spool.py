@@ -0,0 +1,104 @@
+import json
+import threading
+
+import pytest
+
+from benchmark import FakeHTTPServer
+from thingspeak_spool import SampleSpool, ThingSpeakBulkUploader
+
+
+class FakeThingSpeak(FakeHTTPServer):
+    """
+    Bulk update endpoint answering with the queued statuses first, then 202.
+    """
+    def __init__(self):
+        self.statuses = []
+        self.updates = []
+        super(FakeThingSpeak, self).__init__()
+
+    def handle(self, method, path, headers, body):
+        self.count(path)
+        status = self.statuses.pop(0) if self.statuses else 202
+        if status < 400:
+            self.updates.append(json.loads(body.decode('utf-8'))['updates'])
+        return status, {}, {'success': status < 400}
+
+
+@pytest.fixture
+def thingspeak():
+    server = FakeThingSpeak()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def uploader(thingspeak, monkeypatch):
+    monkeypatch.setattr(ThingSpeakBulkUploader, 'BACKOFF_SECONDS', 0)
+    return ThingSpeakBulkUploader(1, 'key', thingspeak.url)
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return SampleSpool(str(tmp_path / 'spool' / 'speedtest.jsonl'))
+
+
+def spooled(spool):
+    with open(spool.path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_outage_loses_nothing_and_catching_up_is_one_request(spool, uploader, thingspeak):
+    thingspeak.statuses = [503] * ThingSpeakBulkUploader.RETRIES
+    for index in range(100):
+        spool.append({'field1': index}, timestamp=1000 + index)
+    with pytest.raises(IOError):
+        spool.flush(uploader.upload, uploader.BATCH_SIZE)
+    assert len(spooled(spool)) == 100
+
+    requests_before = thingspeak.request_count()
+    assert spool.flush(uploader.upload, uploader.BATCH_SIZE) == 100
+    assert thingspeak.request_count() - requests_before == 1
+    assert [update['field1'] for update in thingspeak.updates[0]] == list(range(100))
+    assert spooled(spool) == []
+
+
+def test_samples_are_deduplicated_by_timestamp(spool, uploader, thingspeak):
+    spool.append({'field1': 1}, timestamp=1000)
+    spool.append({'field1': 2}, timestamp=1000)
+    spool.append({'field1': 3}, timestamp=1001)
+    assert spool.flush(uploader.upload, uploader.BATCH_SIZE) == 2
+    assert [update['field1'] for update in thingspeak.updates[0]] == [2, 3]
+
+
+def test_rate_limiting_is_retried(spool, uploader, thingspeak):
+    thingspeak.statuses = [429]
+    spool.append({'field1': 1}, timestamp=1000)
+    assert spool.flush(uploader.upload, uploader.BATCH_SIZE) == 1
+    assert thingspeak.request_count() == 2
+
+
+def test_rejected_batch_is_set_aside(spool, uploader, thingspeak):
+    thingspeak.statuses = [400]
+    for index in range(4):
+        spool.append({'field1': index}, timestamp=1000 + index)
+    assert spool.flush(uploader.upload, 2) == 2
+    assert [update['field1'] for update in thingspeak.updates[0]] == [2, 3]
+    assert spooled(spool) == []
+    with open(spool.rejected_path) as f:
+        assert [json.loads(line)['field1'] for line in f] == [0, 1]
+
+
+def test_appending_during_an_upload_does_not_wait(spool, uploader):
+    spool.append({'field1': 1}, timestamp=1000)
+    batches = []
+
+    def upload(batch):
+        if not batches:
+            appender = threading.Thread(target=spool.append, args=({'field1': 2}, 1001))
+            appender.start()
+            appender.join(timeout=5)
+            assert not appender.is_alive()
+        batches.append(batch)
+
+    assert spool.flush(upload, 10) == 2
+    assert [[sample['field1'] for sample in batch] for batch in batches] == [[1], [2]]
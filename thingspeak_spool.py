@@ -0,0 +1,132 @@
+import fcntl
+import json
+import logging
+import os
+import time
+from lazy_modules import requests
+
+
+class RejectedBatchError(Exception):
+    """
+    The server refused a batch in a way retrying won't fix, e.g. a malformed sample.
+    """
+    pass
+
+
+class SampleSpool(object):
+    """
+    Append-only file of samples that weren't uploaded yet, one JSON object per line.
+    The file is locked while it is read, appended to or rewritten, so several reporters can share it.
+    Batches the server rejects are moved to PATH.rejected, so they can't block the samples behind them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rejected_path = path + '.rejected'
+
+    def append(self, fields, timestamp=None):
+        sample = dict(fields, created_at=int(time.time() if timestamp is None else timestamp))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._append_lines(self.path, [sample])
+
+    def flush(self, upload, batch_size):
+        """
+        Passes the spooled samples, deduplicated by timestamp, to upload in batches.
+        Each uploaded batch is removed from the spool right away, so a failure never re-sends it.
+        The spool isn't locked during uploads, samples appended meanwhile are sent in a later batch.
+        Returns the number of samples uploaded.
+        """
+        uploaded = 0
+        while True:
+            batch = self._read()[:batch_size]
+            if not batch:
+                return uploaded
+            try:
+                upload(batch)
+                uploaded += len(batch)
+            except RejectedBatchError as e:
+                logging.error("Moving {count} rejected samples to {path}: {error}".format(
+                              count=len(batch), path=self.rejected_path, error=e))
+                self._append_lines(self.rejected_path, batch)
+            self._remove(batch)
+
+    def _read(self):
+        try:
+            f = open(self.path, 'r')
+        except FileNotFoundError:
+            return []
+        with f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return self._parse(f)
+
+    def _parse(self, f):
+        samples = {}
+        for line in f:
+            try:
+                sample = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash while appending
+                logging.warning("Dropping corrupt spooled sample: " + line.strip())
+                continue
+            samples[sample['created_at']] = sample
+        return [samples[created_at] for created_at in sorted(samples)]
+
+    def _remove(self, batch):
+        done = set(sample['created_at'] for sample in batch)
+        with open(self.path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            samples = [sample for sample in self._parse(f) if sample['created_at'] not in done]
+            f.seek(0)
+            f.truncate()
+            f.writelines(json.dumps(sample, sort_keys=True) + '\n' for sample in samples)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _append_lines(self, path, samples):
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.writelines(json.dumps(sample, sort_keys=True) + '\n' for sample in samples)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class ThingSpeakBulkUploader(object):
+    """
+    Uploads batches of samples through ThingSpeak's bulk update endpoint, retrying with exponential backoff.
+    Raises RejectedBatchError on client errors other than rate limiting and IOError once the retries run out.
+    """
+    DEFAULT_URL = "https://api.thingspeak.com"
+    # ThingSpeak accepts at most 960 updates per bulk request on free channels
+    BATCH_SIZE = 960
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S +0000'
+    RETRIES = 4
+    BACKOFF_SECONDS = 2
+    TIMEOUT_SECONDS = 30
+
+    def __init__(self, channel_id, write_key, url=None):
+        self.url = "{url}/channels/{channel}/bulk_update.json".format(url=(url or self.DEFAULT_URL).rstrip('/'),
+                                                                      channel=channel_id)
+        self.write_key = write_key
+        self.session = requests.Session()
+
+    def upload(self, samples):
+        updates = [dict(sample, created_at=time.strftime(self.TIME_FORMAT, time.gmtime(sample['created_at'])))
+                   for sample in samples]
+        body = {'write_api_key': self.write_key, 'updates': updates}
+        delay = self.BACKOFF_SECONDS
+        for attempt in range(1, self.RETRIES + 1):
+            try:
+                response = self.session.post(self.url, json=body, timeout=self.TIMEOUT_SECONDS)
+                if response.status_code < 400:
+                    return
+                error = "HTTP {code}: {text}".format(code=response.status_code, text=response.text)
+                # Client errors other than rate limiting won't succeed on a retry
+                if response.status_code != 429 and response.status_code < 500:
+                    raise RejectedBatchError(error)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            if attempt == self.RETRIES:
+                raise IOError("ThingSpeak bulk update failed: " + error)
+            logging.warning("ThingSpeak bulk update failed ({error}), retrying in {delay}s".format(
+                            error=error, delay=delay))
+            time.sleep(delay)
+            delay *= 2
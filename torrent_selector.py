@@ -0,0 +1,108 @@
+import operator
+import re
+
+# Filters look like status:stopped, name~regex, name:text or ratio>2
+RE_FILTER = re.compile(r"^(?P<field>[a-z]+)(?P<operator>:|~|>=|<=|>|<|=)(?P<value>.+)$")
+RE_ID_RANGE = re.compile(r"^(?P<first>\d+)(-(?P<last>\d+))?$")
+RE_NODE_KEY = re.compile(r"^(?P<node>[A-Za-z][\w-]*):(?P<ids>[\d,-]+)$")
+NUMBER_OPERATORS = {'>': operator.gt, '<': operator.lt, '>=': operator.ge, '<=': operator.le, '=': operator.eq,
+                    ':': operator.eq}
+NUMBER_FIELDS = {
+    'id': lambda torrent: torrent.id,
+    'ratio': lambda torrent: torrent.uploadRatio,
+    'progress': lambda torrent: torrent.progress,
+}
+MAX_RANGE_LENGTH = 100000
+
+
+def parse_ids(text):
+    """
+    Parses id lists like '1-50,72' into a set of ids, None if text isn't an id list.
+    """
+    ids = set()
+    for part in text.split(','):
+        mo = RE_ID_RANGE.match(part.strip())
+        if not mo:
+            return None
+        first = int(mo.group('first'))
+        last = int(mo.group('last') or first)
+        if last < first or last - first > MAX_RANGE_LENGTH:
+            return None
+        ids.update(range(first, last + 1))
+    return ids
+
+
+def parse_selection(text):
+    """
+    Turns a selection such as '1-50,72 status:stopped name~^Linux' into a predicate on torrents.
+    All the terms must match. Raises ValueError on terms it doesn't understand.
+    """
+    terms = text.split()
+    if not terms:
+        raise ValueError("Empty selection")
+    predicates = [_parse_term(term) for term in terms]
+    return lambda torrent: all(predicate(torrent) for predicate in predicates)
+
+
+def split_by_node(text, node_names):
+    """
+    Routes a selection to nodes. Torrent keys like seedbox1:12 or seedbox1:1-5 pick torrents of a node and
+    node:seedbox1 picks a node, the other terms filter on every picked node (on all nodes when none is picked).
+    Returns {node name: selection}. With several nodes, bare torrent ids raise ValueError since they're ambiguous.
+    """
+    ids_by_node = {}
+    picked = []
+    filters = []
+    for term in text.split():
+        mo = RE_NODE_KEY.match(term)
+        if mo and mo.group('node') in node_names:
+            ids_by_node.setdefault(mo.group('node'), []).append(mo.group('ids'))
+        elif term.startswith('node:'):
+            name = term[len('node:'):]
+            if name not in node_names:
+                raise ValueError("Unknown node: " + name)
+            picked.append(name)
+        elif len(node_names) > 1 and parse_ids(term) is not None:
+            raise ValueError("Torrent ids need their node, like {node}:{ids}".format(node=node_names[0], ids=term))
+        else:
+            filters.append(term)
+
+    names = [name for name in node_names if name in ids_by_node or name in picked] or node_names
+    selections = {}
+    for name in names:
+        ids = [",".join(ids_by_node[name])] if name in ids_by_node else []
+        selections[name] = " ".join(ids + filters)
+    return selections
+
+
+def _parse_term(term):
+    ids = parse_ids(term)
+    if ids is not None:
+        return lambda torrent: torrent.id in ids
+
+    mo = RE_FILTER.match(term)
+    if not mo:
+        raise ValueError("Unknown selection: " + term)
+    field, op, value = mo.group('field', 'operator', 'value')
+
+    if field == 'status' and op == ':':
+        status = value.replace('_', ' ').lower()
+        return lambda torrent: torrent.status == status
+    if field == 'name' and op == '~':
+        try:
+            regex = re.compile(value, re.IGNORECASE)
+        except re.error as e:
+            raise ValueError("Bad regular expression {value}: {error}".format(value=value, error=e))
+        return lambda torrent: regex.search(torrent.name) is not None
+    if field == 'name' and op == ':':
+        lowered = value.lower()
+        return lambda torrent: lowered in torrent.name.lower()
+    if field in NUMBER_FIELDS and op in NUMBER_OPERATORS:
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError("Not a number: " + value)
+        getter = NUMBER_FIELDS[field]
+        compare = NUMBER_OPERATORS[op]
+        return lambda torrent: compare(getter(torrent), number)
+    raise ValueError("Unknown selection: " + term)
@@ -0,0 +1,171 @@
+import json
+import logging
+import threading
+import time
+import requests
+import transmissionrpc
+from transmissionrpc.httphandler import HTTPHandler, HTTPHandlerError
+from instrumentation import instrumentation
+from workers import backend_limits
+
+
+class SessionHTTPHandler(HTTPHandler):
+    """
+    transmissionrpc HTTP handler that keeps one keep-alive connection to the daemon.
+    """
+    def __init__(self):
+        self.session = requests.Session()
+
+    def set_authentication(self, uri, login, password):
+        self.session.auth = (login, password)
+
+    def request(self, url, query, headers, timeout):
+        try:
+            response = self.session.post(url, data=query.encode('utf-8'), headers=headers, timeout=timeout)
+        except requests.RequestException as e:
+            raise HTTPHandlerError(httpurl=url, httpmsg=str(e))
+        if response.status_code != 200:
+            # transmissionrpc drops headers that aren't a plain dict, and with them the 409's session id
+            raise HTTPHandlerError(url, response.status_code, response.reason, dict(response.headers),
+                                   response.content.decode('utf-8', 'replace'))
+        return response.content.decode('utf-8')
+
+
+class TransmissionClientPool(object):
+    """
+    Holds a long-lived transmissionrpc client and rebuilds it when the daemon goes away.
+    """
+    RETRIES = 3
+    BACKOFF_SECONDS = 0.5
+    MAX_BACKOFF_SECONDS = 4
+
+    def __init__(self, address='localhost', port=9091, user=None, password=None, timeout=10, retries=RETRIES,
+                 backend="transmission"):
+        self.address = address
+        self.port = port
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.retries = retries
+        # The backend_limits slot, remote nodes have their own
+        self.backend = backend
+        self.generation = 0
+        self.torrents = TorrentCache(self)
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = transmissionrpc.Client(self.address, self.port, self.user, self.password,
+                                                      http_handler=SessionHTTPHandler(), timeout=self.timeout)
+                self.generation += 1
+            return self._client
+
+    def reset(self):
+        with self._lock:
+            self._client = None
+
+    def call(self, method, *args, **kwargs):
+        return self._with_retries(method, lambda client: getattr(client, method)(*args, **kwargs))
+
+    def rpc(self, method, arguments=None):
+        """
+        Sends a raw RPC request and returns its arguments, for replies transmissionrpc doesn't fully expose
+        (e.g. the 'removed' list of a recently-active torrent-get).
+        """
+        query = json.dumps({'method': method, 'arguments': arguments or {}})
+
+        def request(client):
+            data = json.loads(client._http_query(query))
+            if data['result'] != 'success':
+                raise transmissionrpc.TransmissionError('Query failed with result "{result}".'.format(**data))
+            return data['arguments']
+
+        return self._with_retries(method, request)
+
+    def _with_retries(self, method, request):
+        delay = self.BACKOFF_SECONDS
+        with instrumentation.span("backend", "transmission." + method):
+            for attempt in range(1, self.retries + 1):
+                try:
+                    # Taken per attempt, a call backing off doesn't keep others waiting
+                    with backend_limits.slot(self.backend):
+                        return request(self.client())
+                except transmissionrpc.TransmissionError as e:
+                    # Only transport failures are retried; RPC level errors won't change on a retry
+                    if e.original is None or attempt == self.retries:
+                        raise
+                    logging.warning("Transmission {method} failed ({error}), reconnecting in {delay}s".format(
+                                    method=method, error=e, delay=delay))
+                    self.reset()
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.MAX_BACKOFF_SECONDS)
+
+
+class TorrentCache(object):
+    """
+    Keeps the torrent list in memory and refreshes it with only the fields the bot uses.
+    After the first full fetch, refreshes ask for recently-active torrents only and apply the removed ids.
+    """
+    # progress and status are derived by transmissionrpc from sizeWhenDone/leftUntilDone and status
+    FIELDS = ['id', 'name', 'status', 'totalSize', 'sizeWhenDone', 'leftUntilDone', 'rateDownload', 'eta',
+              'uploadRatio']
+    # Transmission considers a torrent recently active for 60 seconds, refresh fully past that
+    INCREMENTAL_WINDOW_SECONDS = 50
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._torrents = None
+        self._generation = None
+        self._refreshed_at = 0
+        self._lock = threading.Lock()
+
+    def list(self):
+        with self._lock:
+            arguments = None
+            if self._is_incremental_refresh_possible():
+                arguments = self.pool.rpc('torrent-get', {'fields': self.FIELDS, 'ids': 'recently-active'})
+                # Torrent ids are only stable for the lifetime of a daemon, a reconnect needs a full refresh
+                if self._generation != self.pool.generation:
+                    arguments = None
+                else:
+                    for torrent_id in arguments.get('removed', []):
+                        self._torrents.pop(torrent_id, None)
+
+            if arguments is None:
+                arguments = self.pool.rpc('torrent-get', {'fields': self.FIELDS})
+                self._torrents = {}
+
+            client = self.pool.client()
+            for fields in arguments['torrents']:
+                self._torrents[fields['id']] = transmissionrpc.Torrent(client, fields)
+            self._generation = self.pool.generation
+            self._refreshed_at = time.monotonic()
+            return [self._torrents[torrent_id] for torrent_id in sorted(self._torrents)]
+
+    def discard(self, torrent_ids):
+        with self._lock:
+            if self._torrents is not None:
+                for torrent_id in torrent_ids:
+                    self._torrents.pop(torrent_id, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._torrents = None
+
+    def _is_incremental_refresh_possible(self):
+        return (self._torrents is not None and self._generation == self.pool.generation and
+                time.monotonic() - self._refreshed_at < self.INCREMENTAL_WINDOW_SECONDS)
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool():
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = TransmissionClientPool()
+        return _shared_pool
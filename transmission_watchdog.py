@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+"""
+Probes Transmission's RPC and restarts the daemon only after sustained failure.
+
+    transmission_watchdog.py             probes once, for cron
+    transmission_watchdog.py --daemon    probes every watchdog_interval seconds
+"""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from variables import Variables, join_path_to_script_directory
+from log_pipeline import configure_log
+from transmission_client import TransmissionClientPool
+
+RESTART_COMMAND = "/usr/sbin/service transmission-daemon restart"
+RESTART_TIMEOUT_SECONDS = 120
+
+
+HISTORY_PATH = join_path_to_script_directory('spool/transmission_watchdog.json')
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of values, None when there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+class HealthHistory(object):
+    """
+    Probe results (timestamp, latency in seconds or None on failure) and restart times, kept in a JSON file.
+    """
+    MAX_PROBES = 7 * 24 * 60
+    MAX_RESTARTS = 50
+
+    def __init__(self, path=HISTORY_PATH):
+        self.path = path
+        self.probes = []
+        self.restarts = []
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self.probes = data.get("probes", [])
+            self.restarts = data.get("restarts", [])
+        except (OSError, ValueError):
+            pass
+
+    def add_probe(self, latency, timestamp=None):
+        self.probes.append((time.time() if timestamp is None else timestamp, latency))
+        del self.probes[:-self.MAX_PROBES]
+
+    def add_restart(self, timestamp=None):
+        self.restarts.append(time.time() if timestamp is None else timestamp)
+        del self.restarts[:-self.MAX_RESTARTS]
+
+    def probes_since(self, timestamp):
+        return [(probe_time, latency) for probe_time, latency in self.probes if probe_time >= timestamp]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({"probes": self.probes, "restarts": self.restarts}, f)
+        os.replace(temp_path, self.path)
+
+
+class TransmissionWatchdog(object):
+    """
+    Restarts Transmission when at least failures of the last window probes failed.
+    Probes taken before the last restart don't count, so the daemon gets a fresh window after a restart.
+    """
+    def __init__(self, history, window=5, failures=3, probe_timeout=10):
+        self.history = history
+        self.window = window
+        self.failures = failures
+        self.pool = TransmissionClientPool(timeout=probe_timeout, retries=1)
+
+    def probe(self):
+        started_at = time.monotonic()
+        try:
+            self.pool.rpc("session-stats")
+            latency = time.monotonic() - started_at
+            logging.info("Transmission OK, session-stats took %.3fs", latency)
+        except Exception as e:
+            latency = None
+            logging.warning("Transmission probe failed: %s", e)
+            self.pool.reset()
+        self.history.add_probe(latency)
+        return latency
+
+    def check(self):
+        self.probe()
+        if self._is_unhealthy():
+            self.restart()
+        self.history.save()
+
+    def _is_unhealthy(self):
+        last_restart = self.history.restarts[-1] if self.history.restarts else 0
+        recent = self.history.probes_since(last_restart)[-self.window:]
+        return sum(1 for probe_time, latency in recent if latency is None) >= self.failures
+
+    def restart(self):
+        from notifier import notify
+
+        logging.warning("Transmission not responding, restarting daemon")
+        try:
+            subprocess.run(RESTART_COMMAND, shell=True, timeout=RESTART_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            logging.error("Restarting Transmission timed out")
+        self.history.add_restart()
+        self.pool.reset()
+        notify("Transmission Watchdog", "Restarted the daemon")
+
+
+def main():
+    configure_log("transmission_watchdog")
+    variables = Variables()
+    watchdog = TransmissionWatchdog(HealthHistory(),
+                                    window=variables.get_int("watchdog_window", 5),
+                                    failures=variables.get_int("watchdog_failures", 3),
+                                    probe_timeout=variables.get_int("watchdog_probe_timeout", 10))
+    if sys.argv[1:] == ['--daemon']:
+        interval = variables.get_int("watchdog_interval", 60)
+        while True:
+            watchdog.check()
+            time.sleep(interval)
+    else:
+        watchdog.check()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,79 @@
 import os
 import re
+import threading
+import time
+
+
+def join_path_to_script_directory(path):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
 
 class Variables(object):
-    RE_VAR = r"^(?P<option>.*?)=(?P<value>.*)?$"
+    """
+    Read-only view of variables.cfg.
+    The file is parsed once per process and parsed again only when it changes on disk.
+    """
+    RE_VAR = re.compile(r"^(?P<option>.*?)=(?P<value>.*)?$")
     FILE_NAME = 'variables.cfg'
+    STAT_INTERVAL_SECONDS = 1
+    TRUE_VALUES = ('yes', 'true', 'on', '1')
+
+    _lock = threading.Lock()
+    _config = None
+    _file_key = None
+    _checked_at = 0
 
     def __init__(self):
-        config_file_path = self._join_path_to_script_directory(self.FILE_NAME)
+        self.config = self._load()
+
+    def __getitem__(self, key):
+        return self.config[key]
+
+    def __contains__(self, key):
+        return key in self.config
+
+    def get(self, key, default=None):
+        return self.config.get(key, default)
 
-        self.config = {}
+    def get_bool(self, key, default=False):
+        value = self.config.get(key)
+        if value is None:
+            return default
+        return value.strip().lower() in self.TRUE_VALUES
+
+    def get_int(self, key, default=None):
+        value = self.config.get(key)
+        if value is None or not value.strip():
+            return default
+        return int(value)
+
+    @classmethod
+    def _load(cls):
+        with cls._lock:
+            now = time.monotonic()
+            if cls._config is not None and now - cls._checked_at < cls.STAT_INTERVAL_SECONDS:
+                return cls._config
+
+            config_file_path = join_path_to_script_directory(cls.FILE_NAME)
+            stat = os.stat(config_file_path)
+            file_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if file_key != cls._file_key:
+                cls._config = cls._parse(config_file_path)
+                cls._file_key = file_key
+            cls._checked_at = now
+            return cls._config
+
+    @classmethod
+    def _parse(cls, config_file_path):
+        config = {}
         with open(config_file_path) as config_file:
             for idx, line in enumerate(config_file):
-                mo = re.compile(self.RE_VAR).match(line)
+                mo = cls.RE_VAR.match(line)
                 if not mo:
-                    raise ValueError(FILE_NAME + ':' + str(idx) + ' illegal line pattern')    
+                    raise ValueError(cls.FILE_NAME + ':' + str(idx) + ' illegal line pattern')
                 name, val = mo.group('option', 'value')
-                self.config[name] = val
-
-    def __getitem__(self, key):
-        return self.config[key]
-
-    def _join_path_to_script_directory(self, path):
-        return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+                config[name] = val
+        return config
 
 
 def main():
@@ -30,4 +82,4 @@ def main():
     print(v.config)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from instrumentation import instrumentation
+from variables import Variables
+
+WORKERS = 8
+MAX_PENDING = 10
+# Concurrent calls allowed per backend (and per node) unless backend_limit_NAME says otherwise
+BACKEND_LIMITS = {'flexget': 2, 'transmission': 4, 'crashplan': 2}
+
+
+class WorkerPool(object):
+    """
+    A bounded pool of threads running work submitted under a key, e.g. a chat id.
+    Work for one key runs in order, one item at a time, while different keys share the threads round-robin.
+    Each key queues at most max_pending items, so one busy chat can't grow the backlog without bound.
+    """
+    def __init__(self, workers=WORKERS, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="worker")
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, function, *args):
+        """
+        Queues function(*args) behind the key's earlier work. Returns False when the key's queue is full.
+        """
+        item = (time.perf_counter(), function, args)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                self._queues[key] = deque([item])
+                self._executor.submit(self._run_next, key)
+                return True
+            if len(queue) >= self.max_pending:
+                return False
+            queue.append(item)
+            return True
+
+    def pending(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _run_next(self, key):
+        with self._lock:
+            submitted_at, function, args = self._queues[key].popleft()
+        instrumentation.record("queue", "worker", time.perf_counter() - submitted_at)
+        try:
+            function(*args)
+        except Exception:
+            logging.exception("Worker failed running {function}".format(function=function))
+        finally:
+            with self._lock:
+                if self._queues[key]:
+                    # Back of the line, so other keys get a turn first
+                    self._executor.submit(self._run_next, key)
+                else:
+                    del self._queues[key]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class BackendLimits(object):
+    """
+    Caps concurrent calls per backend, configured by backend_limit_NAME (e.g. backend_limit_flexget=2).
+    A slot named NAME:NODE is one of the node's own slots, so a slow node can't hold up the others' calls.
+    Time spent waiting for a slot is recorded as ('queue', NAME) or ('queue', NAME:NODE).
+    """
+    def __init__(self, defaults=None):
+        self.defaults = dict(BACKEND_LIMITS if defaults is None else defaults)
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, name):
+        with self._lock:
+            semaphore = self._semaphores.get(name)
+            if semaphore is None:
+                # Read once, semaphores can't be resized while they're held
+                backend = name.split(":", 1)[0]
+                limit = Variables().get_int("backend_limit_" + backend, self.defaults.get(backend))
+                semaphore = threading.BoundedSemaphore(limit) if limit else None
+                self._semaphores[name] = semaphore
+            return semaphore
+
+    @contextmanager
+    def slot(self, name):
+        semaphore = self._semaphore(name)
+        if semaphore is None:
+            yield
+            return
+        started_at = time.perf_counter()
+        with semaphore:
+            instrumentation.record("queue", name, time.perf_counter() - started_at)
+            yield
+
+
+backend_limits = BackendLimits()